@@ -0,0 +1,108 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Time adapting objects in nested sites to token brokers.
+
+Builds a tree of `zope.site` folders, each level of which is a site whose
+site manager is based on the one above, registers the token utility in the
+root site and adapts an object at the bottom of the tree to `ITokenBroker`
+many times, using the broker's utility each time.  A broker looking the
+utility up when it is created, as earlier versions did, is timed against the
+current broker, which looks it up when it is first used, and against a
+broker factory bound to the utility.
+"""
+
+import argparse
+import time
+
+import zope.component
+import zope.interface
+import zope.interface.interfaces
+import zope.location.interfaces
+import zope.location.traversing
+import zope.site.folder
+import zope.site.site
+
+from zope.locking import adapters
+from zope.locking import interfaces
+from zope.locking import utility
+
+
+class LookupTokenBroker(adapters.TokenBroker):
+    """Looks the utility up when it is created"""
+
+    def __init__(self, context):
+        super().__init__(context, zope.component.getUtility(
+            interfaces.ITokenUtility, context=context))
+
+
+def setUp(options):
+    zope.component.provideAdapter(
+        zope.location.traversing.LocationPhysicallyLocatable,
+        (zope.location.interfaces.ILocation,),
+        zope.location.interfaces.ILocationInfo)
+    zope.component.provideAdapter(
+        zope.site.site.SiteManagerAdapter,
+        (zope.interface.Interface,),
+        zope.interface.interfaces.IComponentLookup)
+    root = zope.site.folder.rootFolder()
+    root.setSiteManager(zope.site.site.LocalSiteManager(root))
+    util = utility.TokenUtility()
+    root.getSiteManager().registerUtility(util, interfaces.ITokenUtility)
+    folder = root
+    for i in range(options.sites):
+        folder['site'] = site = zope.site.folder.Folder()
+        site.setSiteManager(zope.site.site.LocalSiteManager(site))
+        folder = site
+        for j in range(options.folders):
+            folder['folder'] = folder = zope.site.folder.Folder()
+    obj = folder['obj'] = zope.site.folder.Folder()
+    return util, obj
+
+
+def run(name, factory, util, obj, options):
+    gsm = zope.component.getGlobalSiteManager()
+    gsm.registerAdapter(factory, (zope.interface.Interface,),
+                        interfaces.ITokenBroker)
+    best = None
+    for i in range(options.repeat):
+        start = time.perf_counter()
+        for j in range(options.adaptations):
+            assert interfaces.ITokenBroker(obj).utility is util
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print('%-12s %8.2fms for %d adaptations %6.2fus each' % (
+        name, best * 1e3, options.adaptations,
+        best / options.adaptations * 1e6))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--adaptations', type=int, default=10000,
+                        help='number of objects adapted')
+    parser.add_argument('--sites', type=int, default=8,
+                        help='number of nested sites below the root site')
+    parser.add_argument('--folders', type=int, default=1,
+                        help='number of folders between two sites')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='times to repeat, keeping the best')
+    options = parser.parse_args(args)
+    util, obj = setUp(options)
+    run('lookup', LookupTokenBroker, util, obj, options)
+    run('lazy', adapters.TokenBroker, util, obj, options)
+    run('bound', adapters.boundTokenBroker(util), util, obj, options)
+
+
+if __name__ == '__main__':
+    main()
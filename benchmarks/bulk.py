@@ -0,0 +1,165 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compare the bulk token utility methods with one call per object.
+
+Locks a "subtree" of new objects through the token broker, refreshes the
+locks and ends them, first with `lock`, the duration setter and `end` for
+each object and then with `lockMany`, `refreshMany` and `endMany`.  Each
+step is committed.  The utility starts out with some locks of other
+principals, and expired locks waiting to be cleaned up.
+"""
+
+import argparse
+import datetime
+import time
+
+import persistent
+import persistent.interfaces
+import transaction
+import ZODB
+import ZODB.MappingStorage
+import zope.component
+import zope.interface
+import zope.interface.interfaces
+import zope.keyreference.interfaces
+import zope.keyreference.persistent
+import zope.security.interfaces
+import zope.security.management
+
+from zope.locking import adapters
+from zope.locking import interfaces
+from zope.locking import tokens
+from zope.locking import utility
+from zope.locking import utils
+
+
+@zope.interface.implementer(zope.security.interfaces.IPrincipal)
+class Principal:
+
+    def __init__(self, id):
+        self.id = id
+        self.title = self.description = id
+
+
+@zope.interface.implementer(zope.security.interfaces.IParticipation)
+class Participation:
+
+    interaction = None
+
+    def __init__(self, principal):
+        self.principal = principal
+
+
+@zope.interface.implementer(zope.interface.interfaces.IComponentLookup)
+@zope.component.adapter(zope.interface.Interface)
+def siteManager(obj):
+    return zope.component.getGlobalSiteManager()
+
+
+def setUp():
+    zope.component.provideAdapter(
+        zope.keyreference.persistent.KeyReferenceToPersistent,
+        (persistent.interfaces.IPersistent,),
+        zope.keyreference.interfaces.IKeyReference)
+    zope.component.provideAdapter(siteManager)
+    zope.component.provideAdapter(adapters.TokenBroker)
+
+
+def makeObjects(conn, count):
+    objects = [persistent.Persistent() for i in range(count)]
+    for obj in objects:
+        conn.add(obj)
+    return objects
+
+
+def one_by_one(folder, objects, duration):
+    locks = []
+    for obj in objects:
+        locks.append(interfaces.ITokenBroker(obj).lock(duration=duration))
+    yield 'lock'
+    for lock in locks:
+        lock.duration = duration * 2
+    yield 'refresh'
+    for lock in locks:
+        lock.end()
+    yield 'end'
+
+
+def bulk(folder, objects, duration):
+    broker = interfaces.ITokenBroker(folder)
+    locks = broker.lockMany(objects, duration=duration)
+    yield 'lock'
+    broker.utility.refreshMany(locks, duration * 2)
+    yield 'refresh'
+    broker.utility.endMany(locks)
+    yield 'end'
+
+
+def run(name, steps, options):
+    db = ZODB.DB(ZODB.MappingStorage.MappingStorage())
+    conn = db.open()
+    util = utility.TokenUtility()
+    conn.root()['token_util'] = util
+    conn.add(util)
+    zope.component.provideUtility(util, interfaces.ITokenUtility)
+    # other principals' locks, and locks that will have expired
+    clock = utils.FakeClock()
+    utils.setClock(clock)
+    for i, obj in enumerate(makeObjects(conn, options.background)):
+        duration = datetime.timedelta(
+            minutes=1 if i % 2 else options.minutes)
+        util.register(tokens.ExclusiveLock(obj, 'other-%d' % (i % 50),
+                                           duration))
+    folder = persistent.Persistent()
+    conn.add(folder)
+    objects = makeObjects(conn, options.objects)
+    transaction.commit()
+    clock.advance(minutes=2)
+    zope.security.management.newInteraction(Participation(Principal('joe')))
+    timings = []
+    try:
+        start = time.perf_counter()
+        for step in steps(folder, objects, options.duration):
+            transaction.commit()
+            end = time.perf_counter()
+            timings.append((step, end - start))
+            start = end
+    finally:
+        zope.security.management.endInteraction()
+        utils.setClock(None)
+        conn.close()
+        db.close()
+    print('%-12s %s %8.3fs total' % (
+        name,
+        ' '.join('%s %8.3fs' % timing for timing in timings),
+        sum(timing[1] for timing in timings)))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--objects', type=int, default=5000,
+                        help='number of objects locked together')
+    parser.add_argument('--background', type=int, default=5000,
+                        help='number of locks already in the utility')
+    parser.add_argument('--minutes', type=float, default=30,
+                        help='duration of the locks in minutes')
+    options = parser.parse_args(args)
+    options.duration = datetime.timedelta(minutes=options.minutes)
+    setUp()
+    run('one by one', one_by_one, options)
+    run('bulk', bulk, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Measure write conflicts between concurrent lockers.
+
+Several threads, each with its own connection to a FileStorage, repeatedly
+lock new objects and commit, retrying on ConflictError.  The conflict rate is
+reported for a token utility using plain BTrees sets (as before conflict
+resolution), the standard `TokenUtility` and `ShardedTokenUtility`.
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import persistent
+import persistent.interfaces
+import transaction
+import ZODB
+import ZODB.FileStorage
+import zope.component
+import zope.keyreference.interfaces
+import zope.keyreference.persistent
+from BTrees.OOBTree import OOTreeSet
+from ZODB.POSException import ConflictError
+
+from zope.locking import tokens
+from zope.locking import utility
+
+
+class PlainSetTokenUtility(utility.TokenUtility):
+    """Indexes tokens in plain OOTreeSets, which can't resolve conflicts"""
+
+    def _addMany(self, tree, tokens, value):
+        reg = tree.get(value)
+        if reg is None:
+            reg = tree[value] = OOTreeSet()
+        reg.update(tokens)
+
+
+UTILITIES = (
+    ('plain sets', PlainSetTokenUtility),
+    ('TokenUtility', utility.TokenUtility),
+    ('ShardedTokenUtility', utility.ShardedTokenUtility),
+)
+
+
+def worker(db, principal_id, options, results):
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    commits = conflicts = 0
+    try:
+        for i in range(options.transactions):
+            while True:
+                tm.begin()
+                util = conn.root()['token_util']
+                for j in range(options.locks):
+                    obj = persistent.Persistent()
+                    conn.add(obj)
+                    util.register(tokens.ExclusiveLock(
+                        obj, principal_id, options.duration))
+                # pretend to do the rest of the request's work
+                time.sleep(options.think)
+                try:
+                    tm.commit()
+                except ConflictError:
+                    tm.abort()
+                    conflicts += 1
+                else:
+                    commits += 1
+                    break
+    finally:
+        conn.close()
+    results.append((commits, conflicts))
+
+
+def run(name, factory, options):
+    directory = tempfile.mkdtemp()
+    try:
+        db = ZODB.DB(ZODB.FileStorage.FileStorage(
+            os.path.join(directory, 'Data.fs')), pool_size=options.threads)
+        with db.transaction() as conn:
+            conn.root()['token_util'] = factory()
+        results = []
+        threads = [
+            threading.Thread(
+                target=worker,
+                args=(db, 'principal-%d' % (i % options.principals),
+                      options, results))
+            for i in range(options.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        db.close()
+    finally:
+        shutil.rmtree(directory)
+    commits = sum(r[0] for r in results)
+    conflicts = sum(r[1] for r in results)
+    print('%-20s %8d commits %8d conflicts %7.1f%% conflict rate %8.2fs' % (
+        name, commits, conflicts,
+        100.0 * conflicts / (commits + conflicts), elapsed))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--transactions', type=int, default=50,
+                        help='transactions committed by each thread')
+    parser.add_argument('--locks', type=int, default=1,
+                        help='locks registered in each transaction')
+    parser.add_argument('--principals', type=int, default=8,
+                        help='number of distinct principals locking')
+    parser.add_argument('--minutes', type=float, default=30,
+                        help='duration of the locks in minutes')
+    parser.add_argument('--think', type=float, default=0.002,
+                        help='seconds between locking and committing')
+    options = parser.parse_args(args)
+    options.duration = datetime.timedelta(minutes=options.minutes)
+    # plain sets log every failed attempt to resolve a conflict
+    logging.getLogger('ZODB.ConflictResolution').setLevel(logging.CRITICAL)
+    zope.component.provideAdapter(
+        zope.keyreference.persistent.KeyReferenceToPersistent,
+        (persistent.interfaces.IPersistent,),
+        zope.keyreference.interfaces.IKeyReference)
+    for name, factory in UTILITIES:
+        run(name, factory, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Time a request that checks the lock status of many objects.
+
+Each request asks the token broker of every object whether it is locked,
+and for its token, a few times over, as a page listing the objects with
+their lock icons and actions would.  The utility is timed with and without
+its transaction-scoped lookup cache, and against asking `getMany` for all
+the objects at once.
+"""
+
+import argparse
+import time
+
+import persistent
+import persistent.interfaces
+import transaction
+import ZODB
+import ZODB.MappingStorage
+import zope.component
+import zope.interface
+import zope.interface.interfaces
+import zope.keyreference.interfaces
+import zope.keyreference.persistent
+
+from zope.locking import adapters
+from zope.locking import interfaces
+from zope.locking import tokens
+from zope.locking import utility
+
+
+class UncachedTokenUtility(utility.TokenUtility):
+    """Looks every object up in the index, as earlier versions did"""
+
+    def _getLookupCache(self):
+        return None
+
+
+@zope.interface.implementer(zope.interface.interfaces.IComponentLookup)
+@zope.component.adapter(zope.interface.Interface)
+def siteManager(obj):
+    return zope.component.getGlobalSiteManager()
+
+
+def setUp():
+    zope.component.provideAdapter(
+        zope.keyreference.persistent.KeyReferenceToPersistent,
+        (persistent.interfaces.IPersistent,),
+        zope.keyreference.interfaces.IKeyReference)
+    zope.component.provideAdapter(siteManager)
+    zope.component.provideAdapter(adapters.TokenBroker)
+
+
+def one_by_one(util, objects, checks):
+    locked = 0
+    for i in range(checks):
+        for obj in objects:
+            broker = interfaces.ITokenBroker(obj)
+            if util.isLocked(obj) and broker.get() is not None:
+                locked += 1
+    transaction.abort()
+    return locked
+
+
+def many(util, objects, checks):
+    locked = 0
+    for i in range(checks):
+        found = util.getMany(objects)
+        locked += sum(token is not None for token in found.values())
+    transaction.abort()
+    return locked
+
+
+def run(name, factory, request, options):
+    db = ZODB.DB(ZODB.MappingStorage.MappingStorage())
+    conn = db.open()
+    util = factory()
+    conn.root()['token_util'] = util
+    conn.add(util)
+    zope.component.provideUtility(util, interfaces.ITokenUtility)
+    objects = [persistent.Persistent() for i in range(options.objects)]
+    for i, obj in enumerate(objects):
+        conn.add(obj)
+        if i % options.locked == 0:
+            util.register(tokens.ExclusiveLock(obj, 'john'))
+    transaction.commit()
+    best = None
+    for i in range(options.repeat):
+        start = time.perf_counter()
+        request(util, objects, options.checks)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    conn.close()
+    db.close()
+    print('%-12s %8.2fms per request %6.2fus per check' % (
+        name, best * 1e3,
+        best / (options.objects * options.checks) * 1e6))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--objects', type=int, default=500,
+                        help='number of objects checked by a request')
+    parser.add_argument('--checks', type=int, default=4,
+                        help='times each object is checked in a request')
+    parser.add_argument('--locked', type=int, default=5,
+                        help='one object in this many is locked')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='requests to time, keeping the best')
+    options = parser.parse_args(args)
+    setUp()
+    run('uncached', UncachedTokenUtility, one_by_one, options)
+    run('cached', utility.TokenUtility, one_by_one, options)
+    run('getMany', UncachedTokenUtility, many, options)
+
+
+if __name__ == '__main__':
+    main()
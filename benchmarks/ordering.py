@@ -0,0 +1,100 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Time inserting tokens into, and removing them from, a large token set.
+
+This is what the token utility does to the `_principal_ids` set of a
+principal with many locks.  Tokens comparing themselves with the database
+lookups of earlier versions are timed against the current tokens.
+"""
+
+import argparse
+import random
+import time
+
+import transaction
+import ZODB
+import ZODB.MappingStorage
+
+from zope.locking import tokens
+from zope.locking import trees
+
+
+class LookupLock(tokens.ExclusiveLock):
+    """Compares by (database name, oid), looking the database up every time
+    """
+
+    def __eq__(self, other):
+        return (
+            (self._p_jar.db().database_name, self._p_oid) ==
+            (other._p_jar.db().database_name, other._p_oid))
+
+    def __lt__(self, other):
+        return (
+            (self._p_jar.db().database_name, self._p_oid) <
+            (other._p_jar.db().database_name, other._p_oid))
+
+    __hash__ = tokens.ExclusiveLock.__hash__
+
+
+def run(name, factory, options):
+    db = ZODB.DB(ZODB.MappingStorage.MappingStorage())
+    conn = db.open()
+    all_tokens = [factory(None, 'john')
+                  for i in range(options.members + options.operations)]
+    for token in all_tokens:
+        conn.add(token)
+    # insert and remove tokens all over the set
+    random.Random(42).shuffle(all_tokens)
+    members = all_tokens[:options.members]
+    extra = all_tokens[options.members:]
+    tree = trees.TokenTreeSet(members)
+    conn.root()['set'] = tree
+    transaction.commit()
+    best_insert = best_remove = None
+    for i in range(options.repeat):
+        start = time.perf_counter()
+        for token in extra:
+            tree.insert(token)
+        middle = time.perf_counter()
+        for token in extra:
+            tree.remove(token)
+        end = time.perf_counter()
+        if best_insert is None or middle - start < best_insert:
+            best_insert = middle - start
+        if best_remove is None or end - middle < best_remove:
+            best_remove = end - middle
+    transaction.abort()
+    conn.close()
+    db.close()
+    print('%-20s insert %6.2fus remove %6.2fus per token' % (
+        name,
+        best_insert / options.operations * 1e6,
+        best_remove / options.operations * 1e6))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--members', type=int, default=10000,
+                        help='number of tokens already in the set')
+    parser.add_argument('--operations', type=int, default=1000,
+                        help='number of tokens inserted and removed')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='times to repeat, keeping the best')
+    options = parser.parse_args(args)
+    run('database lookups', LookupLock, options)
+    run('ExclusiveLock', tokens.ExclusiveLock, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Measure the size of the database records of tokens and their indexes.
+
+Registers exclusive and shared locks in a token utility on a FileStorage,
+ends some of them (keeping the ended tokens, as an application keeping a
+history of locks would) and reports the size of the records by class.  The
+tokens and index entries pickled the way earlier versions did are measured
+against the current compact format.
+"""
+
+import argparse
+import collections
+import datetime
+import os
+import shutil
+import tempfile
+
+import persistent
+import persistent.interfaces
+import transaction
+import ZODB
+import ZODB.FileStorage
+import ZODB.utils
+import zope.component
+import zope.keyreference.interfaces
+import zope.keyreference.persistent
+
+from zope.locking import tokens
+from zope.locking import utility
+from zope.locking import utils
+
+
+class LegacyExclusiveLock(tokens.ExclusiveLock):
+    """Pickles its attributes as a plain dict, with the annotations"""
+
+    __getstate__ = persistent.Persistent.__getstate__
+    __setstate__ = persistent.Persistent.__setstate__
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._annotations = tokens.AnnotationsMapping()
+
+
+class LegacySharedLock(tokens.SharedLock):
+    """Pickles its attributes as a plain dict, with the annotations"""
+
+    __getstate__ = persistent.Persistent.__getstate__
+    __setstate__ = persistent.Persistent.__setstate__
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._annotations = tokens.AnnotationsMapping()
+
+
+def fill(conn, exclusive, shared, options):
+    util = conn.root()['token_util'] = utility.TokenUtility()
+    conn.add(util)
+    history = conn.root()['history'] = persistent.list.PersistentList()
+    for i in range(options.locks):
+        obj = persistent.Persistent()
+        conn.add(obj)
+        if i % options.shared:
+            token = exclusive(obj, 'principal-%d' % (i % 100),
+                              options.duration)
+        else:
+            token = shared(obj, ('principal-%d' % (i % 100), 'reviewer'),
+                           options.duration)
+        util.register(token)
+        if i % 100 < options.ended:
+            history.append(token)
+        if i % 1000 == 999:
+            transaction.commit()
+    transaction.commit()
+    for token in history:
+        token.end()
+    transaction.commit()
+
+
+def run(name, exclusive, shared, options):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'Data.fs')
+        db = ZODB.DB(ZODB.FileStorage.FileStorage(path))
+        conn = db.open()
+        fill(conn, exclusive, shared, options)
+        conn.close()
+        db.pack()
+        sizes = collections.defaultdict(lambda: [0, 0])
+        for txn in db.storage.iterator():
+            for record in txn:
+                if record.data is None:
+                    continue
+                module, klass = ZODB.utils.get_pickle_metadata(record.data)
+                if klass.startswith('Legacy'):
+                    klass = klass[len('Legacy'):]
+                size = sizes[klass]
+                size[0] += 1
+                size[1] += len(record.data)
+        db.close()
+    finally:
+        shutil.rmtree(directory)
+    print(name)
+    for klass in ('ExclusiveLock', 'SharedLock', 'AnnotationsMapping',
+                  'OOBTree', 'OOBucket', 'TokenTreeSet', 'TokenSet'):
+        count, total = sizes.pop(klass, (0, 0))
+        print('  %-20s %8d records %10d bytes %8.1f bytes each' % (
+            klass, count, total, total / count if count else 0))
+    count = sum(size[0] for size in sizes.values())
+    total = sum(size[1] for size in sizes.values())
+    print('  %-20s %8d records %10d bytes' % ('other', count, total))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--locks', type=int, default=20000,
+                        help='number of locks registered')
+    parser.add_argument('--shared', type=int, default=10,
+                        help='one lock in this many is shared')
+    parser.add_argument('--ended', type=int, default=50,
+                        help='percentage of the locks that are ended')
+    parser.add_argument('--minutes', type=float, default=30,
+                        help='duration of the locks in minutes')
+    options = parser.parse_args(args)
+    options.duration = datetime.timedelta(minutes=options.minutes)
+    zope.component.provideAdapter(
+        zope.keyreference.persistent.KeyReferenceToPersistent,
+        (persistent.interfaces.IPersistent,),
+        zope.keyreference.interfaces.IKeyReference)
+    # the index entries of earlier versions kept frozensets
+    packPrincipalIds = utils.packPrincipalIds
+    utils.packPrincipalIds = frozenset
+    try:
+        run('plain dicts and frozensets', LegacyExclusiveLock,
+            LegacySharedLock, options)
+    finally:
+        utils.packPrincipalIds = packPrincipalIds
+    run('compact', tokens.ExclusiveLock, tokens.SharedLock, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmark the token utility and the token lifecycle.
+
+Each benchmark runs against a token utility (a TokenUtility, or another
+with `--utility`) in a fresh MappingStorage (or, to measure the size of
+commits, FileStorage) database, and takes several samples of the time per
+operation.  The results are printed, and can be
+written as JSON with `--json` and compared with an earlier run with
+`--compare`.  `tox -e benchmarks` runs the suite.
+
+- lock-unlock: registering an exclusive lock and ending it, committing
+  every 100 locks;
+- get[N]: `get` of locked and unlocked objects, with N live locks;
+- iter-principal: listing the 1,000 locks of a principal among the others;
+- shared-churn: adding a principal to a shared lock and removing it again;
+- expiration-sweep: `reap` cleaning out expired locks, per lock;
+- commit-bytes-register, -refresh, -register-again, -end: the size of the
+  transaction records written by one operation, in bytes, and
+  commit-records-*: the number of objects it writes (the lock and the
+  utility's buckets); registering a lock again without changing it should
+  write nothing.
+"""
+
+import argparse
+import datetime
+import importlib.metadata
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import persistent
+import persistent.interfaces
+import transaction
+import ZODB
+import ZODB.FileStorage
+import ZODB.MappingStorage
+import zope.component
+import zope.keyreference.interfaces
+import zope.keyreference.persistent
+
+from zope.locking import memory
+from zope.locking import sqlite
+from zope.locking import tokens
+from zope.locking import utility
+from zope.locking import utils
+
+
+BENCHMARKS = []
+
+
+def sqliteTokenUtility(database):
+    database.directory = tempfile.mkdtemp()
+    return sqlite.SQLiteTokenUtility(
+        os.path.join(database.directory, 'locks.db'),
+        sqlite.PersistentKeys(lambda: database.conn), transaction.manager)
+
+
+# factories of the token utility of a Database
+UTILITIES = {
+    'TokenUtility': lambda database: utility.TokenUtility(),
+    'ShardedTokenUtility': lambda database: utility.ShardedTokenUtility(),
+    'MemoryTokenUtility': lambda database: memory.MemoryTokenUtility(),
+    'SQLiteTokenUtility': sqliteTokenUtility,
+}
+
+
+def benchmark(function):
+    """add a benchmark to the suite.
+
+    A benchmark is called with the options, and yields (name, unit, values)
+    for each of its results.
+    """
+    BENCHMARKS.append(function)
+    return function
+
+
+def setUp():
+    zope.component.provideAdapter(
+        zope.keyreference.persistent.KeyReferenceToPersistent,
+        (persistent.interfaces.IPersistent,),
+        zope.keyreference.interfaces.IKeyReference)
+
+
+class Database:
+
+    def __init__(self, options, storage=None):
+        if storage is None:
+            storage = ZODB.MappingStorage.MappingStorage()
+        # a cache big enough for the indexes, as a server would have
+        self.db = ZODB.DB(storage, cache_size=1000000)
+        self.conn = self.db.open()
+        self.directory = None
+        self.util = UTILITIES[options.utility](self)
+        if isinstance(self.util, persistent.Persistent):
+            self.conn.root()['token_util'] = self.util
+            self.conn.add(self.util)
+        transaction.commit()
+
+    def objects(self, count):
+        objects = [persistent.Persistent() for i in range(count)]
+        for obj in objects:
+            self.conn.add(obj)
+        return objects
+
+    def lock(self, objects, principal_id='other', duration=None, batch=10000):
+        locks = []
+        for start in range(0, len(objects), batch):
+            locks.extend(self.util.registerMany(
+                tokens.ExclusiveLock(obj, principal_id, duration)
+                for obj in objects[start:start + batch]))
+            transaction.commit()
+            self.conn.cacheGC()
+        return locks
+
+    def close(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory)
+
+
+def timed(function, operations):
+    start = time.perf_counter()
+    function()
+    return (time.perf_counter() - start) / operations
+
+
+@benchmark
+def lock_unlock(options):
+    database = Database(options)
+    objects = database.objects(options.operations)
+    transaction.commit()
+    util = database.util
+
+    def run():
+        for start in range(0, len(objects), 100):
+            for obj in objects[start:start + 100]:
+                util.register(tokens.ExclusiveLock(obj, 'john')).end()
+            transaction.commit()
+
+    values = [timed(run, len(objects)) for i in range(options.repeat)]
+    database.close()
+    yield 'lock-unlock', 's', values
+
+
+@benchmark
+def get(options):
+    rng = random.Random(42)
+    for size in options.sizes:
+        database = Database(options)
+        locked = database.objects(size)
+        database.lock(locked)
+        unlocked = database.objects(size)
+        transaction.commit()
+        util = database.util
+
+        def run():
+            for obj in sample:
+                util.get(obj)
+
+        values = []
+        for i in range(options.repeat + 1):
+            sample = (rng.sample(locked, min(size, options.operations // 2))
+                      + rng.sample(unlocked,
+                                   min(size, options.operations // 2)))
+            rng.shuffle(sample)
+            value = timed(run, len(sample))
+            if i:  # the first run loads the index
+                values.append(value)
+            # forget the lookups of this sample
+            transaction.abort()
+        database.close()
+        yield 'get[%d]' % size, 's', values
+
+
+@benchmark
+def iter_principal(options):
+    database = Database(options)
+    database.lock(database.objects(options.sizes[0]))
+    database.lock(database.objects(1000), 'john')
+    util = database.util
+
+    def run():
+        assert len(list(util.iterForPrincipalId('john'))) == 1000
+
+    values = [timed(run, 1000) for i in range(options.repeat)]
+    database.close()
+    yield 'iter-principal', 's', values
+
+
+@benchmark
+def shared_churn(options):
+    database = Database(options)
+    objects = database.objects(100)
+    locks = database.util.registerMany(
+        tokens.SharedLock(obj, ('john', 'mary')) for obj in objects)
+    transaction.commit()
+
+    def run():
+        for i in range(options.operations):
+            lock = locks[i % len(locks)]
+            lock.add(('susan',))
+            lock.remove(('susan',))
+            if i % 100 == 99:
+                transaction.commit()
+        transaction.commit()
+
+    values = [timed(run, options.operations) for i in range(options.repeat)]
+    database.close()
+    yield 'shared-churn', 's', values
+
+
+@benchmark
+def expiration_sweep(options):
+    values = []
+    for i in range(options.repeat):
+        with utils.FakeClock() as clock:
+            database = Database(options)
+            database.lock(database.objects(options.operations),
+                          duration=datetime.timedelta(minutes=5))
+            clock.advance(minutes=10)
+
+            def run():
+                database.util.reap()
+                transaction.commit()
+
+            values.append(timed(run, options.operations))
+            assert len(database.util) == 0
+            database.close()
+    yield 'expiration-sweep', 's', values
+
+
+def committed_records(storage, last):
+    """return the number of records committed since transaction `last`"""
+    tid = storage.lastTransaction()
+    if tid == last:
+        return 0
+    return sum(len(list(txn)) for txn in storage.iterator(tid, tid))
+
+
+@benchmark
+def commit_bytes(options):
+    directory = tempfile.mkdtemp()
+    try:
+        storage = ZODB.FileStorage.FileStorage(
+            os.path.join(directory, 'Data.fs'))
+        database = Database(options, storage)
+        # other locks, so that the indexes have some depth
+        database.lock(database.objects(options.sizes[0]))
+        objects = database.objects(options.repeat)
+        transaction.commit()
+        operations = ('register', 'refresh', 'register-again', 'end')
+        sizes = {name: [] for name in operations}
+        records = {name: [] for name in operations}
+        duration = datetime.timedelta(minutes=30)
+        locks = []
+
+        def measure(name, operation):
+            size = storage.getSize()
+            last = storage.lastTransaction()
+            operation()
+            transaction.commit()
+            sizes[name].append(storage.getSize() - size)
+            records[name].append(committed_records(storage, last))
+
+        for obj in objects:
+            measure('register', lambda: locks.append(database.util.register(
+                tokens.ExclusiveLock(obj, 'john', duration))))
+        for lock in locks:
+            def refresh():
+                lock.remaining_duration = duration * 2
+            measure('refresh', refresh)
+        for lock in locks:
+            measure('register-again', lambda: database.util.register(lock))
+        for lock in locks:
+            measure('end', lock.end)
+        database.close()
+    finally:
+        shutil.rmtree(directory)
+    for name in operations:
+        yield 'commit-bytes-' + name, 'bytes', sizes[name]
+    for name in operations:
+        yield 'commit-records-' + name, 'records', records[name]
+
+
+def summarize(name, unit, values):
+    return {
+        'name': name,
+        'unit': unit,
+        'values': values,
+        'min': min(values),
+        'median': statistics.median(values),
+        'mean': statistics.mean(values),
+        'stdev': statistics.stdev(values) if len(values) > 1 else 0.0,
+    }
+
+
+def format_value(value, unit):
+    if unit == 's':
+        return '%9.2fus' % (value * 1e6)
+    return '%9.0f %s' % (value, unit)
+
+
+def run(options):
+    setUp()
+    results = []
+    for function in BENCHMARKS:
+        if options.only and function.__name__ not in options.only:
+            continue
+        for name, unit, values in function(options):
+            result = summarize(name, unit, values)
+            results.append(result)
+            print('%-30s median %s  min %s  (%d samples)' % (
+                name, format_value(result['median'], unit),
+                format_value(result['min'], unit), len(values)))
+            sys.stdout.flush()
+    return {
+        'version': 1,
+        'zope.locking': importlib.metadata.version('zope.locking'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'options': {
+            'utility': options.utility,
+            'operations': options.operations,
+            'repeat': options.repeat,
+            'sizes': options.sizes,
+        },
+        'benchmarks': results,
+    }
+
+
+def compare(old, new):
+    """print the change of the medians of the benchmarks in both runs"""
+    old = {result['name']: result for result in old['benchmarks']}
+    for result in new['benchmarks']:
+        before = old.get(result['name'])
+        if before is None or not before['median']:
+            continue
+        print('%-30s %s -> %s  %+6.1f%%' % (
+            result['name'],
+            format_value(before['median'], before['unit']),
+            format_value(result['median'], result['unit']),
+            (result['median'] / before['median'] - 1) * 100))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--operations', type=int, default=2000,
+                        help='operations timed in each sample')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='samples taken of each benchmark')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma-separated numbers of live locks for the '
+                             'get benchmark; the first is also the number '
+                             'of other locks in the others')
+    parser.add_argument('--utility', default='TokenUtility',
+                        choices=sorted(UTILITIES),
+                        help='the token utility to benchmark')
+    parser.add_argument('--only', action='append',
+                        choices=[function.__name__ for function in BENCHMARKS],
+                        help='run only this benchmark (may be repeated)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='write the results to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with an earlier --json')
+    options = parser.parse_args(args)
+    options.sizes = [int(size) for size in options.sizes.split(',')]
+    results = run(options)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if options.compare:
+        with open(options.compare) as f:
+            print()
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
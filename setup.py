@@ -52,20 +52,31 @@ setup(
     install_requires=[
         'BTrees',
         'persistent',
+        # only to load the datetimes stored by earlier versions
         'pytz',
         'setuptools',
+        'transaction',
         'zope.component',
         'zope.event',
         'zope.generations',
         'zope.interface >= 3.8',
         'zope.keyreference',
+        'zope.lifecycleevent',
         'zope.location',
         'zope.schema',
         'zope.security',
     ],
     zip_safe=False,
     tests_require=tests_require,
-    extras_require={'test': tests_require},
+    extras_require={
+        'test': tests_require,
+        'check': ['ZODB'],
+    },
+    entry_points={
+        'console_scripts': [
+            'zope-locking-check = zope.locking.integrity:main',
+        ],
+    },
     description=(
         'Advisory exclusive locks, shared locks, and freezes '
         '(locked to no-one).'),
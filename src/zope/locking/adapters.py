@@ -12,10 +12,13 @@
 #
 ##############################################################################
 
+import functools
+
 import zope.security.management
 
 from zope import component
 from zope import interface
+from zope.locking import instrumentation
 from zope.locking import interfaces
 from zope.locking import tokens
 
@@ -24,10 +27,17 @@ from zope.locking import tokens
 @interface.implementer(interfaces.ITokenBroker)
 class TokenBroker:
 
-    def __init__(self, context):
+    def __init__(self, context, utility=None):
         self.context = self.__parent__ = context
-        self.utility = component.getUtility(
-            interfaces.ITokenUtility, context=context)
+        if utility is not None:
+            self.utility = utility
+
+    @functools.cached_property
+    @instrumentation.timed('broker.utility')
+    def utility(self):
+        # looked up when first used
+        return component.getUtility(
+            interfaces.ITokenUtility, context=self.context)
 
     # for subclasses to call, to avoid duplicating code
     def _getLockPrincipalId(self, principal_id):
@@ -42,10 +52,18 @@ class TokenBroker:
             raise interfaces.ParticipationError
         return principal_id
 
-    def lock(self, principal_id=None, duration=None):
+    @instrumentation.timed('broker.lock')
+    def lock(self, principal_id=None, duration=None, deep=False):
         principal_id = self._getLockPrincipalId(principal_id)
         return self.utility.register(
-            tokens.ExclusiveLock(self.context, principal_id, duration))
+            tokens.ExclusiveLock(self.context, principal_id, duration, deep))
+
+    @instrumentation.timed('broker.lockMany')
+    def lockMany(self, objects, principal_id=None, duration=None):
+        principal_id = self._getLockPrincipalId(principal_id)
+        return self.utility.registerMany(
+            tokens.ExclusiveLock(obj, principal_id, duration)
+            for obj in objects)
 
     # for subclasses to call, to avoid duplicating code
     def _getSharedLockPrincipalIds(self, principal_ids):
@@ -60,18 +78,38 @@ class TokenBroker:
             raise interfaces.ParticipationError
         return principal_ids
 
-    def lockShared(self, principal_ids=None, duration=None):
+    @instrumentation.timed('broker.lockShared')
+    def lockShared(self, principal_ids=None, duration=None, deep=False):
         principal_ids = self._getSharedLockPrincipalIds(principal_ids)
         return self.utility.register(
-            tokens.SharedLock(self.context, principal_ids, duration))
+            tokens.SharedLock(self.context, principal_ids, duration, deep))
 
+    @instrumentation.timed('broker.freeze')
     def freeze(self, duration=None):
         return self.utility.register(
             tokens.EndableFreeze(self.context, duration))
 
+    @instrumentation.timed('broker.get')
     def get(self):
         return self.utility.get(self.context)
 
+    @instrumentation.timed('broker.getMany')
+    def getMany(self, objects):
+        return self.utility.getMany(objects)
+
+
+def boundTokenBroker(utility):
+    """Return a TokenBroker adapter factory that always uses utility.
+
+    Registered instead of `TokenBroker`, it saves looking the utility up for
+    every object, in applications that only have one.
+    """
+    @component.adapter(interface.Interface)
+    @interface.implementer(interfaces.ITokenBroker)
+    def factory(context):
+        return TokenBroker(context, utility)
+    return factory
+
 
 def getInteractionPrincipals():
     interaction = zope.security.management.queryInteraction()
@@ -86,11 +124,13 @@ class TokenHandler:
     def __getattr__(self, name):
         return getattr(self.token, name)
 
+    @instrumentation.timed('handler.check')
     def _checkInteraction(self):
         if self.token.ended is not None:
             raise interfaces.ExpirationChangedEvent
         interaction_principals = getInteractionPrincipals()
-        token_principals = frozenset(self.token.principal_ids)
+        # already a frozenset
+        token_principals = self.token.principal_ids
         if interaction_principals is not None:
             omitted = interaction_principals.difference(token_principals)
             if omitted:
@@ -142,6 +182,7 @@ class TokenHandler:
 @interface.implementer(interfaces.IExclusiveLockHandler)
 class ExclusiveLockHandler(TokenHandler):
 
+    @instrumentation.timed('handler.release')
     def release(self, principal_ids=None):
         pids, interaction_pids, token_pids = self._getPrincipalIds(
             principal_ids)
@@ -154,11 +195,13 @@ class ExclusiveLockHandler(TokenHandler):
 @interface.implementer(interfaces.ISharedLockHandler)
 class SharedLockHandler(TokenHandler):
 
+    @instrumentation.timed('handler.release')
     def release(self, principal_ids=None):
         pids, interaction_pids, token_pids = self._getPrincipalIds(
             principal_ids)
         self.token.remove(pids)
 
+    @instrumentation.timed('handler.join')
     def join(self, principal_ids=None):
         interaction_principals = getInteractionPrincipals()
         if principal_ids is None:
@@ -169,6 +212,7 @@ class SharedLockHandler(TokenHandler):
             raise interfaces.ParticipationError
         self.token.add(principal_ids)
 
+    @instrumentation.timed('handler.add')
     def add(self, principal_ids):
         self._checkInteraction()
         self.token.add(principal_ids)
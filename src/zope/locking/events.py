@@ -0,0 +1,253 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Sending the token events.
+
+Tokens and the token utility send their events with `notify`, which hands
+them to the installed notifier: `zope.event.notify` by default, or a
+`DeferredEvents` that collects the events of each transaction and sends
+what is left of them just before the transaction commits.
+"""
+
+import contextlib
+import threading
+import time
+import weakref
+
+import zope.event
+
+from zope.locking import instrumentation
+from zope.locking import interfaces
+
+
+_notifier = zope.event.notify
+
+# the events held back in each thread by `_holding`
+_held = threading.local()
+
+
+def notify(event):
+    """Send event with the installed notifier."""
+    held = getattr(_held, 'events', None)
+    if held is not None:
+        held.append(event)
+        return
+    sink = instrumentation.sink
+    if sink is None:
+        _notifier(event)
+        return
+    start = time.perf_counter()
+    _notifier(event)
+    sink.timing('events.notify', (time.perf_counter() - start) * 1000)
+    sink.incr('events.' + type(event).__name__)
+
+
+@contextlib.contextmanager
+def _holding():
+    """hold back the events notified by this thread until the block is left.
+
+    Lets a utility change tokens under a lock and send their events once it
+    is released.  The events are sent even if the block raises, for the
+    tokens changed before.  Nested blocks leave the events to the outermost.
+    """
+    if getattr(_held, 'events', None) is not None:
+        yield
+        return
+    _held.events = held = []
+    try:
+        yield
+    finally:
+        _held.events = None
+        for event in held:
+            notify(event)
+
+
+def getNotifier():
+    """Return the installed notifier."""
+    return _notifier
+
+
+def setNotifier(notifier):
+    """Install notifier, a callable taking an event, for `notify` to use.
+
+    None installs `zope.event.notify` again.
+    """
+    global _notifier
+    _notifier = zope.event.notify if notifier is None else notifier
+
+
+_UNCHANGED = object()
+
+
+class _TokenEvents:
+    """what happened to a token in a transaction"""
+
+    started = ended = False
+    old_principal_ids = old_expiration = _UNCHANGED
+
+    def __init__(self, token):
+        self.token = token
+
+    def add(self, event):
+        if interfaces.ITokenStartedEvent.providedBy(event):
+            self.started = True
+        elif interfaces.ITokenEndedEvent.providedBy(event):
+            self.ended = True
+        elif interfaces.IPrincipalsChangedEvent.providedBy(event):
+            if self.old_principal_ids is _UNCHANGED:
+                self.old_principal_ids = event.old
+        elif interfaces.IExpirationChangedEvent.providedBy(event):
+            if self.old_expiration is _UNCHANGED:
+                self.old_expiration = event.old
+        else:
+            return False
+        return True
+
+    def __iter__(self):
+        token = self.token
+        if self.started:
+            # the subscribers see the token as it is now
+            if not self.ended:
+                yield interfaces.TokenStartedEvent(token)
+        elif self.ended:
+            yield interfaces.TokenEndedEvent(token)
+        else:
+            old = self.old_principal_ids
+            if old is not _UNCHANGED and old != token.principal_ids:
+                yield interfaces.PrincipalsChangedEvent(token, old)
+            old = self.old_expiration
+            if old is not _UNCHANGED and old != token.expiration:
+                yield interfaces.ExpirationChangedEvent(token, old)
+
+
+class _PendingEvents:
+    """the events collected in a transaction.
+
+    It joins the transaction as a data manager with nothing to commit, so
+    that rolling back a savepoint drops the events collected since.
+    `abort` is also called to roll back a savepoint taken before it joined.
+    """
+
+    def __init__(self, transaction_manager):
+        self.transaction_manager = transaction_manager
+        # id(token): _TokenEvents
+        self.tokens = {}
+        # _TokenEvents and (other event,), in order
+        self.order = []
+        self.joined = False
+
+    def join(self, transaction):
+        transaction.join(self)
+        self.joined = True
+
+    # IDataManager
+
+    def abort(self, transaction):
+        self.tokens.clear()
+        del self.order[:]
+        self.joined = False
+
+    def tpc_begin(self, transaction):
+        pass
+
+    def commit(self, transaction):
+        pass
+
+    def tpc_vote(self, transaction):
+        pass
+
+    def tpc_finish(self, transaction):
+        pass
+
+    def tpc_abort(self, transaction):
+        pass
+
+    def sortKey(self):
+        return 'zope.locking.events._PendingEvents:%d' % (id(self),)
+
+    # ISavepointDataManager
+
+    def savepoint(self):
+        return _PendingEventsSavepoint(self)
+
+
+class _PendingEventsSavepoint:
+
+    def __init__(self, pending):
+        self.pending = pending
+        self.length = len(pending.order)
+        self.states = {key: dict(vars(token_events))
+                       for key, token_events in pending.tokens.items()}
+
+    def rollback(self):
+        pending = self.pending
+        del pending.order[self.length:]
+        for key, token_events in list(pending.tokens.items()):
+            state = self.states.get(key)
+            if state is None:
+                del pending.tokens[key]
+            else:
+                vars(token_events).clear()
+                vars(token_events).update(state)
+
+
+class DeferredEvents:
+    """A notifier that sends the token events of a transaction before it
+    commits.
+
+    The events of each token are collapsed: a token started and ended in the
+    same transaction sends nothing, a token started sends only the started
+    event, a token ended sends only the ended event, and otherwise repeated
+    changes send a single event with the first old value, if the value is
+    still different.  Other events are sent in order along with them.  The
+    events of a transaction that is aborted are never sent, nor are those
+    collected since a savepoint that is rolled back.
+    """
+
+    def __init__(self, transaction_manager):
+        self.transaction_manager = transaction_manager
+        self._pending = weakref.WeakKeyDictionary()
+
+    def __call__(self, event):
+        transaction = self.transaction_manager.get()
+        pending = self._pending.get(transaction)
+        if pending is None:
+            pending = self._pending[transaction] = _PendingEvents(
+                self.transaction_manager)
+            transaction.addBeforeCommitHook(self.send, (transaction,))
+        if not pending.joined:
+            pending.join(transaction)
+        tokens, order = pending.tokens, pending.order
+        if interfaces.ITokenEvent.providedBy(event):
+            key = id(event.object)
+            token_events = tokens.get(key)
+            if token_events is None:
+                token_events = _TokenEvents(event.object)
+                if token_events.add(event):
+                    tokens[key] = token_events
+                    order.append(token_events)
+                    return
+            elif token_events.add(event):
+                return
+        order.append((event,))
+
+    @instrumentation.timed('events.send')
+    def send(self, transaction):
+        """send the collapsed events of transaction"""
+        pending = self._pending.pop(transaction, None)
+        if pending is None:
+            return
+        # subscribers changing tokens start a new batch, with a new hook
+        for events in pending.order:
+            for event in events:
+                zope.event.notify(event)
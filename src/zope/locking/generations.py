@@ -12,31 +12,65 @@
 #
 ##############################################################################
 
+import logging
+
+import BTrees.Length
 import BTrees.OOBTree
 import zope.generations.interfaces
 import zope.interface
 
 import zope.locking.interfaces
+import zope.locking.tokens
+import zope.locking.trees
+import zope.locking.utility
 import zope.locking.utils
 
 
+logger = logging.getLogger(__name__)
+
+
 @zope.interface.implementer(
     zope.generations.interfaces.IInstallableSchemaManager)
 class SchemaManager:
-    minimum_generation = 2
-    generation = 2
+    # Generations 4 to 6 are optional: utilities work without them.
+    # Generation 4 in particular loads every locked object and its
+    # ancestors, so it is left for when the database is evolved to the
+    # latest generation on purpose.
+    minimum_generation = 3
+    generation = 6
 
     def install(self, context):
         # Clean up cruft in any existing token utilities.
         # This is done here because zope.locking didn't have a
-        # schema manager prior to 1.2.
+        # schema manager prior to 1.2.  The locations of their tokens are
+        # not indexed, as that would load every locked object.
         clean_locks(context)
+        bucket_expirations(context)
+        drop_empty_annotations(context)
+        count_tokens(context)
 
     def evolve(self, context, generation):
         if generation == 2:
             # Going from generation 1 -> 2, we need to run the token
             # utility fixer again because of a deficiency it had in 1.2.
             clean_locks(context)
+        elif generation == 3:
+            # Going from generation 2 -> 3, the expirations index groups
+            # tokens by time slice rather than by exact expiration.
+            bucket_expirations(context)
+        elif generation == 4:
+            # Going from generation 3 -> 4, the utility indexes the location
+            # of each token, for deep tokens.  This loads every locked
+            # object and its ancestors.
+            index_paths(context)
+        elif generation == 5:
+            # Going from generation 4 -> 5, tokens no longer need an
+            # annotations mapping; drop the empty ones.
+            drop_empty_annotations(context)
+        elif generation == 6:
+            # Going from generation 5 -> 6, the utility keeps counts of its
+            # tokens.
+            count_tokens(context)
 
 
 schemaManager = SchemaManager()
@@ -58,6 +92,39 @@ def clean_locks(context):
             fix_token_utility(util)
 
 
+def bucket_expirations(context):
+    """Group the expirations of token utilities into time slices."""
+    app = context.connection.root().get('Application')
+    if app is not None:
+        for util in find_token_utilities(app):
+            bucket_token_utility(util)
+
+
+def index_paths(context):
+    """Index the locations of the tokens in token utilities."""
+    app = context.connection.root().get('Application')
+    if app is not None:
+        for util in find_token_utilities(app):
+            index_token_utility_paths(util)
+
+
+def drop_empty_annotations(context):
+    """Drop the empty annotations mappings of the tokens in token utilities.
+    """
+    app = context.connection.root().get('Application')
+    if app is not None:
+        for util in find_token_utilities(app):
+            drop_token_utility_annotations(util)
+
+
+def count_tokens(context):
+    """Count the tokens in token utilities."""
+    app = context.connection.root().get('Application')
+    if app is not None:
+        for util in find_token_utilities(app):
+            count_token_utility(util)
+
+
 def find_token_utilities(app_root):
     for sm in get_site_managers(app_root):
         for registration in sm.registeredUtilities():
@@ -65,33 +132,198 @@ def find_token_utilities(app_root):
                 yield registration.component
 
 
-def fix_token_utility(util):
+class _Batches:
+    """Report progress, and take a savepoint, every `size` steps of a repair.
+
+    The savepoints let the database write the changes so far to temporary
+    storage, and the connection cache is garbage collected after each of
+    them, so that repairing a large utility does not hold all of it in
+    memory.  The changes are still committed together, with the new
+    generation.
+    """
+
+    def __init__(self, util, name, size):
+        self.util = util
+        self.name = name
+        self.size = size
+        self.done = 0
+        self._next = size
+
+    def step(self, count=1):
+        self.done += count
+        if self.done >= self._next:
+            self._next = self.done + self.size
+            jar = self.util._p_jar
+            if jar is not None:
+                jar.transaction_manager.savepoint(optimistic=True)
+                jar.cacheGC()
+            logger.info('%s: %d done', self.name, self.done)
+
+    def finish(self):
+        logger.info('%s: %d done, finished', self.name, self.done)
+
+
+def fix_token_utility(util, batch_size=10000):
     """ A bug in versions of zope.locking prior to 1.2 could cause
         token utilities to keep references to expired/ended locks.
 
         This function cleans up any old locks lingering in a token
         utility due to this issue.
+
+        The `_locks` index is read once, to map the oid of each token in it
+        to its key reference, so that no token needs to be loaded.  Progress
+        is logged, with a savepoint, every `batch_size` tokens.
     """
+    now = zope.locking.utils.now()
+    batches = _Batches(util, 'indexing tokens', batch_size)
+    key_refs = {}
+    active = set()
+    for key_ref, entry in util._locks.items():
+        oid = entry[0]._p_oid
+        key_refs[oid] = key_ref
+        if zope.locking.utility._isEntryActive(entry, now):
+            active.add(oid)
+        batches.step()
+    batches.finish()
+    paths = getattr(util, '_paths', None)
+    token_paths = {}
+    if paths is not None:
+        batches = _Batches(util, 'indexing paths', batch_size)
+        for path, token in paths.items():
+            token_paths[token._p_oid] = path
+            batches.step()
+        batches.finish()
+
+    # Only tokens that are active in the `_locks` index stay in the sets.
+    batches = _Batches(util, 'cleaning principals', batch_size)
     for pid in list(util._principal_ids):
-        # iterForPrincipalId only returns non-ended locks, so we know
-        # they're still good.
-        new_tree = BTrees.OOBTree.OOTreeSet(util.iterForPrincipalId(pid))
-        if new_tree:
-            util._principal_ids[pid] = new_tree
-        else:
+        tree = util._principal_ids[pid]
+        tokens = [token for token in tree if token._p_oid in active]
+        if not tokens:
             del util._principal_ids[pid]
-    now = zope.locking.utils.now()
-    for dt, tree in list(util._expirations.items()):
-        if dt > now:
-            util._expirations[dt] = BTrees.OOBTree.OOTreeSet(tree)
-        else:
-            del util._expirations[dt]
+        elif (len(tokens) != len(tree) or
+                not isinstance(tree, zope.locking.trees.TokenTreeSet)):
+            util._principal_ids[pid] = zope.locking.trees.TokenTreeSet(
+                tokens)
+        batches.step(len(tree))
+    batches.finish()
+
+    if isinstance(util._expirations, zope.locking.trees.ShardedSets):
+        expirations = util._expirations._shards
+    else:
+        expirations = (util._expirations,)
+    batches = _Batches(util, 'cleaning expirations', batch_size)
+    for index in expirations:
+        for dt in list(index):
+            tree = index[dt]
+            if isinstance(dt, int):
+                # already grouped by time slice, keyed by seconds since the
+                # epoch
+                expired = dt <= now.timestamp()
+            else:
+                expired = dt <= now
+            if not expired:
+                if not isinstance(tree, zope.locking.trees.TokenTreeSet):
+                    index[dt] = zope.locking.trees.TokenTreeSet(tree)
+                batches.step(len(tree))
+                continue
+            del index[dt]
             for token in tree:
-                # Okay, we could just adapt token.context to IKeyReference
-                # here...but we don't want to touch token.context,
-                # because some wonky objects need a site set before
-                # they can be unpickled.
-                for key_ref, (_token, _, _) in list(util._locks.items()):
-                    if token is _token:
-                        del util._locks[key_ref]
-                        break
+                # We don't want to touch token.context, because some wonky
+                # objects need a site set before they can be unpickled, or
+                # even the token itself: the maps tell us where it is
+                # indexed, if it still is.
+                oid = token._p_oid
+                if oid in active:
+                    # a token that drifted into a past slice while its lock
+                    # is still active keeps its lock, and only leaves the
+                    # slice
+                    batches.step()
+                    continue
+                key_ref = key_refs.pop(oid, None)
+                if key_ref is not None:
+                    del util._locks[key_ref]
+                path = token_paths.pop(oid, None)
+                if path is not None:
+                    del paths[path]
+                batches.step()
+    batches.finish()
+    if util._length is not None:
+        count_token_utility(util)
+
+
+def bucket_token_utility(util):
+    """Reindex the expirations of a token utility by time slice.
+
+    Before generation 3, the `_expirations` index was keyed by the exact
+    expiration of each token.
+    """
+    old = util._expirations
+    if isinstance(old, (zope.locking.trees.ShardedTree,
+                        zope.locking.trees.ShardedSets)):
+        util._expirations = zope.locking.trees.ShardedSets(len(old._shards))
+    else:
+        util._expirations = BTrees.OOBTree.OOBTree()
+    for dt, tree in old.items():
+        key = dt if isinstance(dt, int) else util._expirationKey(dt)
+        for token in tree:
+            util._add(util._expirations, token, key)
+
+
+def index_token_utility_paths(util):
+    """Add the `_paths` index to a token utility from before generation 4.
+
+    This has to load the context of every token, and its ancestors, to find
+    where it is, so it fails on objects that can't be loaded or located
+    without a site set up, as some can't.  Until it is run, the utility
+    goes through all of its tokens to register a deep token.
+    """
+    if isinstance(util._locks, zope.locking.trees.ShardedTree):
+        util._paths = zope.locking.trees.ShardedTree(len(util._locks._shards))
+    else:
+        util._paths = BTrees.OOBTree.OOBTree()
+    for key_ref, entry in util._locks.items():
+        token = entry[0]
+        path = zope.locking.utility._getPath(token.context, key_ref)
+        if isinstance(token, zope.locking.tokens.Token):
+            token._path = path
+        util._paths[path] = token
+
+
+def drop_token_utility_annotations(util):
+    """Drop the empty annotations mappings of the tokens in a token utility.
+
+    Before generation 5, every token was created with a mapping.  Tokens
+    without one now create it when it is used.
+    """
+    for entry in util._locks.values():
+        token = entry[0]
+        if (isinstance(token, zope.locking.tokens.Token) and
+                token._annotations is not None and
+                not token._annotations):
+            del token._annotations
+
+
+def count_token_utility(util):
+    """Count the tokens of a token utility, by kind, and of each principal.
+
+    Before generation 6, the utility counted them when asked.  The kinds are
+    in the `_locks` index, and the counts of the principals are the sizes of
+    their sets, so no token is loaded (except for `_locks` entries from
+    before the kind was indexed).
+    """
+    length = 0
+    kinds = zope.locking.utility._newKindCounts()
+    for entry in util._locks.values():
+        length += 1
+        kinds[zope.locking.utility._getEntryKind(entry)].change(1)
+    util._length = BTrees.Length.Length(length)
+    util._kind_counts = kinds
+    if isinstance(util._principal_ids, zope.locking.trees.ShardedTree):
+        counts = zope.locking.trees.ShardedTree(
+            len(util._principal_ids._shards))
+    else:
+        counts = BTrees.OOBTree.OOBTree()
+    for principal_id, tokens in util._principal_ids.items():
+        counts[principal_id] = BTrees.Length.Length(len(tokens))
+    util._principal_counts = counts
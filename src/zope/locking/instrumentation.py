@@ -0,0 +1,146 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Measuring the token utility, the token broker and the token handlers.
+
+Nothing is measured until a sink is installed with `setSink`.  A sink has
+the `incr(name, count)` and `timing(name, milliseconds)` methods of a statsd
+client, so that one can be installed as it is.  A callable taking
+`(kind, name, value)` is wrapped in a `CallableSink`, and a
+`MemoryCollector` keeps everything in memory, for tests.
+"""
+
+import collections
+import functools
+import time
+
+
+# checked by the instrumented code; None when nothing is measured
+sink = None
+
+
+def getSink():
+    """Return the installed sink, or None."""
+    return sink
+
+
+def setSink(new):
+    """Install a sink for the measurements; None stops measuring.
+
+    A sink without an `incr` method is taken to be a callable, and is
+    wrapped in a `CallableSink`.
+    """
+    global sink
+    if new is not None and not hasattr(new, 'incr'):
+        new = CallableSink(new)
+    sink = new
+
+
+class CallableSink:
+    """A sink calling a function with `('count', name, count)` or
+    `('timing', name, milliseconds)`."""
+
+    def __init__(self, function):
+        self.function = function
+
+    def incr(self, name, count=1):
+        self.function('count', name, count)
+
+    def timing(self, name, milliseconds):
+        self.function('timing', name, milliseconds)
+
+
+class MemoryCollector:
+    """A sink keeping the counters and the timings in memory.
+
+    `counts` maps names to totals, and `timings` maps names to the list of
+    their times, in milliseconds.  It can be used as a context manager that
+    installs it and puts the previous sink back.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.timings = collections.defaultdict(list)
+
+    def incr(self, name, count=1):
+        self.counts[name] += count
+
+    def timing(self, name, milliseconds):
+        self.timings[name].append(milliseconds)
+
+    def clear(self):
+        self.counts.clear()
+        self.timings.clear()
+
+    def __enter__(self):
+        self._previous = sink
+        setSink(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        setSink(self._previous)
+        del self._previous
+
+
+def _loads(obj):
+    jar = getattr(obj, '_p_jar', None)
+    if jar is None:
+        return 0
+    return jar.getTransferCounts()[0]
+
+
+def _writes(obj):
+    # the objects the connection will write, so far, or None if we can't
+    # tell: this is internal to ZODB's Connection
+    registered = getattr(
+        getattr(obj, '_p_jar', None), '_registered_objects', None)
+    if registered is None:
+        return None
+    return len(registered)
+
+
+def timed(name, result=None):
+    """Decorate a method to send the time its calls take, as `name`.
+
+    The objects the connection of the instance (if any) loads meanwhile are
+    counted as `name + '.loads'`, and the objects it changes, that it had not
+    changed before in the transaction, as `name + '.writes'`, if the
+    connection tells.  If `result` is given, the integer the method returns
+    is added to that counter.  When no sink is installed, this only costs
+    the check.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            current = sink
+            if current is None:
+                return method(self, *args, **kwargs)
+            loads = _loads(self)
+            writes = _writes(self)
+            start = time.perf_counter()
+            try:
+                value = method(self, *args, **kwargs)
+            finally:
+                current.timing(name, (time.perf_counter() - start) * 1000)
+                loads = _loads(self) - loads
+                if loads:
+                    current.incr(name + '.loads', loads)
+                if writes is not None:
+                    writes = _writes(self) - writes
+                    if writes:
+                        current.incr(name + '.writes', writes)
+            if result is not None:
+                current.incr(result, value)
+            return value
+        return wrapper
+    return decorate
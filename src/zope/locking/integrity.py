@@ -0,0 +1,304 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Check the indexes of token utilities against each other, and rebuild them.
+
+The `_locks` index of a token utility is the primary one; the
+`_principal_ids`, `_expirations` and `_paths` indexes can be rebuilt from it.
+The indexes are streamed, and the connection cache is garbage collected as
+we go, so that this runs in constant memory on utilities of any size.
+"""
+
+import argparse
+import itertools
+import sys
+
+from BTrees.OOBTree import OOBTree
+
+import zope.locking.generations
+from zope.locking import trees
+from zope.locking import utility
+from zope.locking import utils
+
+
+def _describe(token):
+    oid = token._p_oid
+    if oid is None:
+        return 'token %r' % (token,)
+    return 'token 0x%x' % int.from_bytes(oid, 'big')
+
+
+def _setContains(index, value, token):
+    if isinstance(index, trees.ShardedSets):
+        tokens = index._shard(token).get(value)
+    else:
+        tokens = index.get(value)
+    return tokens is not None and token in tokens
+
+
+def _currentEntry(util, token):
+    """return the `_locks` entry of a token, or None if it isn't current"""
+    entry = util._locks.get(utility._getKeyReference(token))
+    if entry is not None and entry[0] is token:
+        return entry
+    return None
+
+
+class _Progress:
+
+    def __init__(self, util, batch_size):
+        self.jar = util._p_jar
+        self.batch_size = batch_size
+        self.done = 0
+
+    def step(self):
+        self.done += 1
+        if self.done % self.batch_size == 0 and self.jar is not None:
+            self.jar.cacheGC()
+
+
+def needsEvolving(util):
+    """Return why the indexes of a utility are older than this package's.
+
+    Returns None if they are not.  Such a utility can't be checked or
+    rebuilt until the database is evolved with `zope.generations`.
+    """
+    if util._expirations and not isinstance(util._expirations.minKey(), int):
+        return '_expirations is keyed by expiration, not by time slice'
+    return None
+
+
+def checkTokenUtility(util, batch_size=10000):
+    """Iterate over the inconsistencies between the indexes of a utility.
+
+    Yields a message for each.  Tokens whose expiration has passed but that
+    have not been cleaned out yet are consistent, as long as every index
+    still has them.  A utility that needs evolving gets a single message
+    saying why.
+    """
+    reason = needsEvolving(util)
+    if reason is not None:
+        yield 'the database needs evolving: %s' % (reason,)
+        return
+    progress = _Progress(util, batch_size)
+    locks = 0
+    kinds = dict.fromkeys(utility._KINDS, 0)
+    for key_ref, entry in util._locks.items():
+        token = entry[0]
+        locks += 1
+        kinds[utility._getEntryKind(entry)] += 1
+        for principal_id in utils.unpackPrincipalIds(entry[1]):
+            if not _setContains(util._principal_ids, principal_id, token):
+                yield '_principal_ids: %s is missing for %r' % (
+                    _describe(token), principal_id)
+        key = util._expirationKey(entry[2])
+        if key is not None and not _setContains(
+                util._expirations, key, token):
+            yield '_expirations: %s is missing for %r' % (
+                _describe(token), key)
+        progress.step()
+    for principal_id, tokens in util._principal_ids.items():
+        held = 0
+        for token in tokens:
+            held += 1
+            entry = _currentEntry(util, token)
+            if entry is None:
+                yield '_principal_ids: %s for %r is not in _locks' % (
+                    _describe(token), principal_id)
+            elif principal_id not in utils.unpackPrincipalIds(entry[1]):
+                yield '_principal_ids: %s is not held by %r' % (
+                    _describe(token), principal_id)
+            progress.step()
+        if util.countForPrincipalId(principal_id) != held:
+            yield '_principal_counts: %r holds %d tokens, not %d' % (
+                principal_id, held, util.countForPrincipalId(principal_id))
+    # sharded sets give each shard's part of a slice separately
+    for key, tokens in util._expirations.items():
+        for token in tokens:
+            entry = _currentEntry(util, token)
+            if entry is None:
+                yield '_expirations: %s for %r is not in _locks' % (
+                    _describe(token), key)
+            elif util._expirationKey(entry[2]) != key:
+                yield '_expirations: %s does not expire at %r' % (
+                    _describe(token), key)
+            progress.step()
+    paths = 0
+    # utilities from before generation 4 have no `_paths` index
+    for path, token in (util._paths or {}).items():
+        entry = util._locks.get(path[-1])
+        if entry is None or entry[0] is not token:
+            yield '_paths: %s is not in _locks' % (_describe(token),)
+        else:
+            paths += 1
+        progress.step()
+    if util._paths is not None and paths != locks:
+        yield '_paths: %d of the %d tokens in _locks are missing' % (
+            locks - paths, locks)
+    if len(util) != locks:
+        yield '_length: there are %d tokens in _locks, not %d' % (
+            locks, len(util))
+    for kind, count in util.stats().kinds.items():
+        if kinds[kind] != count:
+            yield '_kind_counts: there are %d %s tokens, not %d' % (
+                kinds[kind], kind.__name__, count)
+    if util._principal_counts is not None:
+        for principal_id in util._principal_counts.keys():
+            if principal_id not in util._principal_ids:
+                yield '_principal_counts: %r holds no tokens, not %d' % (
+                    principal_id, util.countForPrincipalId(principal_id))
+
+
+def _emptyLike(index):
+    if isinstance(index, (trees.ShardedTree, trees.ShardedSets)):
+        return type(index)(len(index._shards))
+    return OOBTree()
+
+
+def rebuildTokenUtility(util, batch_size=10000):
+    """Rebuild the secondary indexes of a utility from its `_locks` index.
+
+    The new indexes are filled in a transaction for every `batch_size`
+    tokens, and replace the old ones in the last transaction, along with new
+    counts of the tokens.  Nothing else may change the utility meanwhile.
+    """
+    jar = util._p_jar
+    transaction_manager = jar.transaction_manager
+    names = ('_principal_ids', '_expirations', '_paths')
+    if util._paths is None:
+        # indexing them loads every locked object: see generation 4
+        names = names[:2]
+    new = {name: _emptyLike(getattr(util, name)) for name in names}
+    for index in new.values():
+        jar.add(index)
+    last = None
+    while True:
+        if last is None:
+            items = util._locks.items()
+        else:
+            items = (item for item in util._locks.items(last)
+                     if item[0] != last)
+        batch = list(itertools.islice(items, batch_size))
+        if not batch:
+            break
+        changes = utility._IndexChanges()
+        for key_ref, entry in batch:
+            token = entry[0]
+            for principal_id in utils.unpackPrincipalIds(entry[1]):
+                changes.add('_principal_ids', principal_id, token)
+            key = util._expirationKey(entry[2])
+            if key is not None:
+                changes.add('_expirations', key, token)
+            if '_paths' in new:
+                new['_paths'][utility._getTokenPath(token, key_ref)] = token
+        for name, value, removed, added in changes:
+            util._addMany(new[name], added, value)
+        last = batch[-1][0]
+        del batch, changes
+        transaction_manager.commit()
+        jar.cacheGC()
+    for name in names:
+        setattr(util, name, new[name])
+    zope.locking.generations.count_token_utility(util)
+    transaction_manager.commit()
+
+
+def _findTokenUtilities(root, path):
+    if path:
+        obj = root
+        for key in path.split('/'):
+            if key:
+                obj = obj[key]
+        return [obj]
+    app = root.get('Application')
+    if app is None:
+        return []
+    return list(zope.locking.generations.find_token_utilities(app))
+
+
+def _open(options):
+    import ZODB
+    if options.zeo:
+        try:
+            import ZEO.ClientStorage
+        except ModuleNotFoundError:
+            sys.exit('--zeo needs the ZEO package')
+        address = options.zeo
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+            address = (host, int(port))
+        storage = ZEO.ClientStorage.ClientStorage(
+            address, read_only=not options.rebuild)
+    else:
+        import ZODB.FileStorage
+        storage = ZODB.FileStorage.FileStorage(
+            options.file, read_only=not options.rebuild)
+    return ZODB.DB(storage)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Check the indexes of zope.locking token utilities, '
+                    'and rebuild them from the _locks index.')
+    parser.add_argument('file', nargs='?',
+                        help='the FileStorage (Data.fs) to open')
+    parser.add_argument('--zeo', metavar='ADDRESS',
+                        help='connect to a ZEO server (host:port or socket '
+                             'path) instead of opening a file')
+    parser.add_argument('--path', default='',
+                        help='slash-separated keys leading from the '
+                             'database root to the token utility; by '
+                             'default, every token utility registered in '
+                             'the sites of the Application is checked')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rebuild the indexes of inconsistent utilities '
+                             '(the storage is opened read-only otherwise)')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='number of tokens per transaction when '
+                             'rebuilding, and between cache collections')
+    options = parser.parse_args(args)
+    if bool(options.file) == bool(options.zeo):
+        parser.error('give either a file or --zeo')
+    db = _open(options)
+    status = 0
+    try:
+        conn = db.open()
+        utilities = _findTokenUtilities(conn.root(), options.path)
+        if not utilities:
+            print('no token utilities found')
+            status = 1
+        for util in utilities:
+            name = options.path or getattr(util, '__name__', None) or 'utility'
+            reason = needsEvolving(util)
+            if reason is not None:
+                print('%s: the database needs evolving: %s' % (name, reason))
+                status = 1
+                continue
+            problems = 0
+            for problem in checkTokenUtility(util, options.batch_size):
+                print('%s: %s' % (name, problem))
+                problems += 1
+            print('%s: %d problems' % (name, problems))
+            if problems and options.rebuild:
+                rebuildTokenUtility(util, options.batch_size)
+                print('%s: rebuilt' % (name,))
+            elif problems:
+                status = 1
+        conn.close()
+    finally:
+        db.close()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
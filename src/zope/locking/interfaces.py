@@ -12,6 +12,8 @@
 #
 ##############################################################################
 """Locking interfaces"""
+import datetime
+
 from zope.interface.interfaces import IObjectEvent
 from zope.interface.interfaces import ObjectEvent
 
@@ -34,12 +36,102 @@ class ITokenUtility(interface.Interface):
         Token must be active (not ended), or else return default.
         """
 
-    def iterForPrincipalId(principal_id):
+    def query(obj, default=None):
+        """For obj, return information about the active token, or default.
+
+        The information is a tuple of (token, principal_ids, expiration,
+        kind), also available as attributes of the same names.
+        `principal_ids` is a frozenset, `expiration` is the token's
+        expiration (always None for tokens that are not IEndable), and `kind`
+        is the most specific of IExclusiveLock, ISharedLock, IEndableFreeze,
+        IFreeze, IEndableToken or IToken that the token provides.
+
+        This is answered from the utility's own records, so the token is not
+        loaded from the database unless the caller uses it.
+        """
+
+    def isLocked(obj):
+        """Return whether obj has an active token, as cheaply as possible.
+        """
+
+    def getMany(objects):
+        """Return a dict mapping each of objects to its active IToken or None.
+
+        The `_locks` index is read once in order, rather than once for each
+        object, and the tokens are not loaded from the database.
+        """
+
+    def getEffective(obj, default=None):
+        """Return the active IToken that applies to obj, or default.
+
+        That is obj's own token, or else the active `deep` token of its
+        nearest ancestor (following `__parent__`) that has one.
+        """
+
+    def reindexMoved(obj, old_parent):
+        """Update the locations of the tokens of obj and of the objects below
+        it, after obj has moved away from old_parent.
+
+        The location of a token decides which tokens a `deep` token covers.
+        `zope.locking.utility.objectMoved`, a subscriber for
+        IObjectMovedEvent, calls this.
+        """
+
+    def iterForPrincipalId(principal_id, start=None, limit=None):
         """Return an iterable of all active tokens held by the principal id.
+
+        The tokens come in a stable order.  To page through them, pass the
+        last token of the previous page as `start`, to continue after it,
+        and the size of the page as `limit`.
         """
 
-    def __iter__():
+    def countForPrincipalId(principal_id):
+        """Return the number of tokens held by the principal id.
+
+        This is kept as tokens come and go, rather than counted.  Tokens that
+        have expired count until they are cleaned out (see `reap`).
+        """
+
+    def __iter__(start=None, limit=None):
         """Return iterable of active tokens managed by utility.
+
+        The tokens come in a stable order; `start` and `limit` page through
+        them as for `iterForPrincipalId`.
+        """
+
+    def __len__():
+        """Return the number of tokens managed by the utility.
+
+        This is kept as tokens come and go, rather than counted.  Tokens that
+        have expired count until they are cleaned out (see `reap`).
+        """
+
+    def stats(principal_ids=(), expiring_within=datetime.timedelta(hours=1)):
+        """Return statistics about the tokens, as cheaply as possible.
+
+        The statistics are a tuple of (tokens, kinds, pending, expiring,
+        principals), also available as attributes of the same names.
+        `tokens` is the number of tokens in the utility, as `len` counts
+        them, and `kinds` a dict of the number of tokens of each kind (see
+        `query`).  `pending` is the number of expired tokens waiting to be
+        cleaned out, and `expiring` the number of tokens that will expire
+        within `expiring_within`, a timedelta.  Expirations are counted by
+        the time slices of the utility's index, so they may be up to a
+        minute off.  `principals` is a dict of the number of tokens held by
+        each of the principal ids, or by every principal with tokens if
+        `principal_ids` is None.
+
+        The counts are kept as tokens come and go, so this does not load any
+        token.
+        """
+
+    def iterExpiringBetween(start=None, end=None):
+        """Return an iterable of the tokens expiring from start until end.
+
+        `start` (inclusive) and `end` (exclusive) are timezone-aware
+        datetimes, or None for no limit.  The tokens come roughly in order of
+        expiration, and include expired tokens that have not been cleaned out
+        yet.
         """
 
     def register(token):
@@ -50,6 +142,56 @@ class ITokenUtility(interface.Interface):
         Raises ValueError if token has been registered to another utility.
 
         If lock has never been registered before, fires TokenStartedEvent.
+
+        Raises RegistrationError if the object already has an active token,
+        if one of its ancestors has an active `deep` token or, for a `deep`
+        token, if anything below the object has an active token.
+
+        May also clean a limited number of expired tokens out of the utility's
+        internal data structures.
+        """
+
+    def registerMany(tokens):
+        """register several new ITokens at once, and return them as a list.
+
+        Either all of the tokens are registered or, if any of them could not
+        be registered by `register`, none of them are; the same errors are
+        raised.  ValueError is raised if a token, or another token for the
+        same object, is given more than once.
+
+        Fires a TokenStartedEvent for each new token once all of them are
+        registered, and cleans up expired tokens only once.
+        """
+
+    def endMany(tokens):
+        """end several registered IEndable tokens at once, and return them.
+
+        Raises EndedError if any of the tokens has already ended, or
+        ValueError if any of them is registered with another utility or is
+        given more than once, before ending any of them.  Each token still
+        fires its own TokenEndedEvent.
+        """
+
+    def refreshMany(tokens, duration):
+        """set the remaining duration of several registered IEndable tokens.
+
+        `duration` is a datetime.timedelta, or None for no expiration.  The
+        same checks as for `endMany` are made, and ValueError is raised for a
+        negative duration, before any token is changed.  Each token still
+        fires its own ExpirationChangedEvent.
+        """
+
+    def reap(max_tokens=None, max_seconds=None):
+        """Clean expired tokens out of the utility's internal data structures.
+
+        Stops after `max_tokens` tokens have been removed or after roughly
+        `max_seconds` seconds, whichever comes first; None means no limit.
+        Returns the number of tokens removed.
+
+        Expired tokens are never returned by `get`, `iterForPrincipalId` or
+        `__iter__`, whether or not they have been reaped.  This method lets a
+        separate process (a clock server or cron job, for instance) do the
+        cleanup in its own small transactions.
         """
 
 
@@ -84,6 +226,11 @@ class IAbstractToken(interface.Interface):
         or None if the object is not locked.   If object is frozen, returns
         an iterable with no members.  Readonly.""")
 
+    deep = schema.Bool(
+        description=("""whether the token also applies to everything below
+        the locked object, following `__parent__`.  Readonly."""),
+        required=False, readonly=True, default=False)
+
     started = schema.Datetime(
         description=("""the date and time, with utc timezone, that the token
         was registered with the token utility and became effective.  Required
@@ -251,7 +398,7 @@ class ITokenBroker(interface.Interface):
     __parent__ = interface.Attribute(
         """the context.  readonly.  Important for security.""")
 
-    def lock(principal_id=None, duration=None):
+    def lock(principal_id=None, duration=None, deep=False):
         """lock context, and return token.
 
         if principal_id is None, use interaction's principal; if interaction
@@ -260,10 +407,12 @@ class ITokenBroker(interface.Interface):
         if principal_id is not None, principal_id must be in interaction,
         or else raise ParticipationError.
 
+        If deep is true, the lock also applies to everything below context.
+
         Same constraints as token utility's register method.
         """
 
-    def lockShared(principal_ids=None, duration=None):
+    def lockShared(principal_ids=None, duration=None, deep=False):
         """lock context with a shared lock, and return token.
 
         if principal_ids is None, use interaction's principals; if interaction
@@ -272,9 +421,20 @@ class ITokenBroker(interface.Interface):
         if principal_ids is not None, principal_ids must be in interaction,
         or else raise ParticipationError.  Must be at least one id.
 
+        If deep is true, the lock also applies to everything below context.
+
         Same constraints as token utility's register method.
         """
 
+    def lockMany(objects, principal_id=None, duration=None):
+        """exclusively lock all of objects, and return the tokens as a list.
+
+        The principal id is determined as for `lock`.  The locks are
+        registered with the token utility's `registerMany`, so either all of
+        the objects are locked or none of them are.  The context is used only
+        as the security context and to find the utility.
+        """
+
     def freeze(duration=None):
         """freeze context with an endable freeze, and return token.
         """
@@ -284,6 +444,13 @@ class ITokenBroker(interface.Interface):
 
         """
 
+    def getMany(objects):
+        """Return a dict mapping each of objects to its active IToken or None.
+
+        The context is used only to find the utility, whose `getMany` is
+        used.
+        """
+
 ##############################################################################
 # Token handler interfaces
 ##############################################################################
@@ -0,0 +1,423 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A token utility that keeps its tokens in memory.
+
+`MemoryTokenUtility` behaves like `TokenUtility` for processes that do not
+keep their tokens in a ZODB, such as services without a database and tests.
+Its indexes are plain dicts, and its expirations a heap.  Nothing is
+persistent, and tokens are not added to a database.
+"""
+
+import bisect
+import datetime
+import heapq
+import itertools
+import threading
+import time
+
+from zope.keyreference.interfaces import IKeyReference
+from zope.location import Location
+
+from zope import interface
+from zope.locking import events
+from zope.locking import instrumentation
+from zope.locking import interfaces
+from zope.locking import tokens
+from zope.locking import utility
+from zope.locking import utils
+
+
+@interface.implementer(interfaces.ITokenUtility)
+class MemoryTokenUtility(Location):
+    """A token utility that keeps its tokens in memory, for one process.
+
+    Its indexes may be used by several threads at once; the tokens
+    themselves are not locked.
+    """
+
+    # as for TokenUtility
+    cleanup_limit = 10
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # key reference: (token, principal ids, expiration, kind, deep,
+        # path), as in the `_locks` index of TokenUtility, with the path of
+        # the object at the end
+        self._locks = {}
+        # id of the context of a token in `_locks`: its key reference, so
+        # that looking a locked object up does not adapt it again
+        self._contexts = {}
+        # key reference: {key references below it with a token: None}
+        self._below = {}
+        # principal id: {id(token): token}
+        self._principal_ids = {}
+        # a heap of (expiration, sequence, key reference, token).  Changing a
+        # token leaves its old items in place; they are skipped when they
+        # come up, and dropped when the heap is rebuilt.
+        self._expirations = []
+        self._sequence = itertools.count()
+        self._kind_counts = dict.fromkeys(utility._KINDS, 0)
+
+    def _pushExpiration(self, key_ref, entry):
+        if entry[2] is None:
+            return
+        heap = self._expirations
+        if len(heap) > 2 * len(self._locks) + 100:
+            heap[:] = [
+                (other[2], next(self._sequence), other_ref, other[0])
+                for other_ref, other in self._locks.items()
+                if other[2] is not None and other_ref != key_ref]
+            heapq.heapify(heap)
+        heapq.heappush(heap, (entry[2], next(self._sequence), key_ref,
+                              entry[0]))
+
+    def _addPrincipal(self, principal_id, token):
+        self._principal_ids.setdefault(principal_id, {})[id(token)] = token
+
+    def _removePrincipal(self, principal_id, token):
+        held = self._principal_ids[principal_id]
+        del held[id(token)]
+        if not held:
+            del self._principal_ids[principal_id]
+
+    def _makeEntry(self, token, path):
+        return utility._makeEntry(token) + (path,)
+
+    def _getKeyReference(self, obj):
+        # the context of a token in `_locks` is kept alive, so its id is not
+        # reused while it is there
+        key_ref = self._contexts.get(id(obj))
+        if key_ref is None:
+            key_ref = IKeyReference(obj)
+        return key_ref
+
+    def _addEntry(self, key_ref, entry):
+        self._locks[key_ref] = entry
+        self._kind_counts[utility._getEntryKind(entry)] += 1
+        self._contexts[id(entry[0].context)] = key_ref
+        for ancestor in entry[5][:-1]:
+            self._below.setdefault(ancestor, {})[key_ref] = None
+        for principal_id in utils.unpackPrincipalIds(entry[1]):
+            self._addPrincipal(principal_id, entry[0])
+        self._pushExpiration(key_ref, entry)
+
+    def _removeEntry(self, key_ref):
+        entry = self._locks.pop(key_ref)
+        self._kind_counts[utility._getEntryKind(entry)] -= 1
+        del self._contexts[id(entry[0].context)]
+        for ancestor in entry[5][:-1]:
+            below = self._below[ancestor]
+            del below[key_ref]
+            if not below:
+                del self._below[ancestor]
+        for principal_id in utils.unpackPrincipalIds(entry[1]):
+            self._removePrincipal(principal_id, entry[0])
+
+    def _reindexEntry(self, key_ref, old, new):
+        self._locks[key_ref] = new
+        token = new[0]
+        old_principal_ids = utils.unpackPrincipalIds(old[1])
+        new_principal_ids = utils.unpackPrincipalIds(new[1])
+        for principal_id in old_principal_ids.difference(new_principal_ids):
+            self._removePrincipal(principal_id, token)
+        for principal_id in new_principal_ids.difference(old_principal_ids):
+            self._addPrincipal(principal_id, token)
+        if new[2] != old[2]:
+            self._pushExpiration(key_ref, new)
+
+    def reindexMoved(self, obj, old_parent):
+        paths = utility._getMovedPaths(obj, old_parent)
+        if paths is None or paths[0] == paths[1]:
+            return
+        old_path, new_path = paths
+        with self._lock:
+            for key_ref in [old_path[-1]] + list(
+                    self._below.get(old_path[-1], ())):
+                entry = self._locks.get(key_ref)
+                if entry is None or entry[5][:len(old_path)] != old_path:
+                    continue
+                path = new_path + entry[5][len(old_path):]
+                for ancestor in entry[5][:-1]:
+                    below = self._below[ancestor]
+                    del below[key_ref]
+                    if not below:
+                        del self._below[ancestor]
+                for ancestor in path[:-1]:
+                    self._below.setdefault(ancestor, {})[key_ref] = None
+                self._locks[key_ref] = entry[:5] + (path,)
+                if isinstance(entry[0], tokens.Token):
+                    entry[0]._path = path
+
+    @instrumentation.timed('cleanup', result='cleanup.reaped')
+    def _cleanup(self, max_tokens=None, deadline=None):
+        """clean out expired tokens, as `TokenUtility._cleanup` does."""
+        count = 0
+        now = utils.now()
+        heap = self._expirations
+        while heap and heap[0][0] <= now:
+            if (max_tokens is not None and count >= max_tokens or
+                    deadline is not None and time.monotonic() > deadline):
+                break
+            expiration, sequence, key_ref, token = heapq.heappop(heap)
+            entry = self._locks.get(key_ref)
+            if (entry is not None and entry[0] is token and
+                    entry[2] == expiration):
+                self._removeEntry(key_ref)
+                count += 1
+        return count
+
+    def reap(self, max_tokens=None, max_seconds=None):
+        deadline = None
+        if max_seconds is not None:
+            deadline = time.monotonic() + max_seconds
+        with self._lock:
+            return self._cleanup(max_tokens, deadline)
+
+    def _check(self, token):
+        """check that token may be registered, as `TokenUtility._check`
+        does."""
+        assert interfaces.IToken.providedBy(token)
+        if token.utility is not None and token.utility is not self:
+            raise ValueError('Lock is already registered with another utility')
+        key_ref = getattr(token, '_key_ref', None)
+        if key_ref is None:
+            key_ref = self._getKeyReference(token.context)
+        current = self._locks.get(key_ref)
+        path = utility._getTokenPath(token, key_ref)
+        if current is None or current[0] is not token:
+            now = utils.now()
+            if current is not None and utility._getEntryKind(
+                    current).isOrExtends(interfaces.IEndable) and (
+                    utility._isEntryActive(current, now)):
+                raise interfaces.RegistrationError(token)
+            for ancestor in path[:-1]:
+                entry = self._locks.get(ancestor)
+                if (entry is not None and utility._isEntryDeep(entry) and
+                        utility._isEntryActive(entry, now)):
+                    raise interfaces.RegistrationError(token)
+            if getattr(token, 'deep', False):
+                for other in self._below.get(key_ref, ()):
+                    if utility._isEntryActive(self._locks[other], now):
+                        raise interfaces.RegistrationError(token)
+        return key_ref, current, path
+
+    def _index(self, token, key_ref, current, path):
+        """index a token that has passed `_check`.
+
+        Returns True if the token is new to the utility.
+        """
+        if token.utility is None:
+            token.utility = self
+        if isinstance(token, tokens.Token):
+            if token._key_ref is None:
+                token._key_ref = key_ref
+            if token._path is None:
+                token._path = path
+        if current is not None and current[0] is token:
+            endable = current[3].isOrExtends(interfaces.IEndable)
+            if endable and token.ended:
+                self._removeEntry(key_ref)
+            else:
+                # the kind, depth and path of a token never change
+                self._reindexEntry(key_ref, current, (
+                    token, utils.packPrincipalIds(token.principal_ids),
+                    token.expiration if endable else None) + current[3:])
+            return False
+        if current is not None:
+            self._removeEntry(key_ref)
+        self._addEntry(key_ref, self._makeEntry(token, path))
+        return True
+
+    @instrumentation.timed('register')
+    def register(self, token):
+        with self._lock:
+            key_ref, current, path = self._check(token)
+            is_new = self._index(token, key_ref, current, path)
+            heap = self._expirations
+            if heap and heap[0][0] <= utils.now():
+                self._cleanup(self.cleanup_limit)
+        if is_new:
+            events.notify(interfaces.TokenStartedEvent(token))
+        return token
+
+    @instrumentation.timed('registerMany')
+    def registerMany(self, tokens):
+        tokens = list(tokens)
+        with self._lock:
+            checked = []
+            seen = {}
+            for token in tokens:
+                key_ref, current, path = self._check(token)
+                utility._checkOnce(seen, key_ref, token)
+                checked.append((token, key_ref, current, path))
+            utility._checkBatch(checked)
+            started = [token for token, key_ref, current, path in checked
+                       if self._index(token, key_ref, current, path)]
+            self._cleanup(self.cleanup_limit)
+        for token in started:
+            events.notify(interfaces.TokenStartedEvent(token))
+        return tokens
+
+    def _checkRegistered(self, tokens):
+        tokens = list(tokens)
+        seen = set()
+        for token in tokens:
+            if not interfaces.IEndable.providedBy(token):
+                raise TypeError('token is not endable', token)
+            if token.utility is not self:
+                raise ValueError('token is not registered with this utility')
+            if token.ended:
+                raise interfaces.EndedError(token)
+            if id(token) in seen:
+                raise ValueError('token is given more than once', token)
+            seen.add(id(token))
+        return tokens
+
+    def endMany(self, tokens):
+        with events._holding(), self._lock:
+            tokens = self._checkRegistered(tokens)
+            for token in tokens:
+                token.end()
+        return tokens
+
+    def refreshMany(self, tokens, duration):
+        if duration is not None:
+            if not isinstance(duration, datetime.timedelta):
+                raise ValueError('duration must be datetime.timedelta')
+            if duration < datetime.timedelta():
+                raise ValueError('duration may not be negative')
+        with events._holding(), self._lock:
+            tokens = self._checkRegistered(tokens)
+            for token in tokens:
+                token.remaining_duration = duration
+        return tokens
+
+    def _query(self, obj):
+        """return the index entry for obj if its token is active, or None."""
+        res = self._locks.get(self._getKeyReference(obj))
+        if res is not None and res[2] is not None and res[2] <= utils.now():
+            res = None
+        if instrumentation.sink is not None:
+            instrumentation.sink.incr('get.miss' if res is None else 'get.hit')
+        return res
+
+    def get(self, obj, default=None):
+        res = self._query(obj)
+        if res is not None:
+            return res[0]
+        return default
+
+    def query(self, obj, default=None):
+        res = self._query(obj)
+        if res is not None:
+            return utility.TokenInfo(
+                res[0], utils.unpackPrincipalIds(res[1]), res[2],
+                utility._getEntryKind(res))
+        return default
+
+    def isLocked(self, obj):
+        return self._query(obj) is not None
+
+    def getMany(self, objects):
+        now = utils.now()
+        result = {}
+        for obj in objects:
+            entry = self._locks.get(self._getKeyReference(obj))
+            if entry is not None and utility._isEntryActive(entry, now):
+                result[obj] = entry[0]
+            else:
+                result[obj] = None
+        return result
+
+    def getEffective(self, obj, default=None):
+        path = utility._getPath(obj)
+        now = utils.now()
+        with self._lock:
+            entry = self._locks.get(path[-1])
+            if entry is not None and utility._isEntryActive(entry, now):
+                return entry[0]
+            for ancestor in reversed(path[:-1]):
+                entry = self._locks.get(ancestor)
+                if (entry is not None and utility._isEntryDeep(entry) and
+                        utility._isEntryActive(entry, now)):
+                    return entry[0]
+        return default
+
+    def iterForPrincipalId(self, principal_id, start=None, limit=None):
+        # ordered by the ids of the tokens, which is how tokens outside of a
+        # database sort
+        with self._lock:
+            held = self._principal_ids.get(principal_id, {})
+            keys = sorted(held)
+            if start is not None:
+                keys = keys[bisect.bisect_right(keys, id(start)):]
+            locks = [held[key] for key in keys]
+        yield from itertools.islice(
+            (lock for lock in locks if not lock.ended), limit)
+
+    def countForPrincipalId(self, principal_id):
+        return len(self._principal_ids.get(principal_id, ()))
+
+    def __iter__(self, start=None, limit=None):
+        now = utils.now()
+        with self._lock:
+            # ordered by the ids of the tokens, as for `iterForPrincipalId`
+            entries = sorted(self._locks.values(),
+                             key=lambda entry: id(entry[0]))
+            if start is not None:
+                entries = entries[bisect.bisect_right(
+                    [id(entry[0]) for entry in entries], id(start)):]
+        yield from itertools.islice(
+            (entry[0] for entry in entries
+             if utility._isEntryActive(entry, now)),
+            limit)
+
+    def __len__(self):
+        return len(self._locks)
+
+    def __bool__(self):
+        # the utility is there even when it has no tokens
+        return True
+
+    def stats(self, principal_ids=(), expiring_within=utility._ONE_HOUR):
+        now = utils.now()
+        horizon = now + expiring_within
+        pending = expiring = 0
+        with self._lock:
+            kinds = dict(self._kind_counts)
+            for entry in self._locks.values():
+                expiration = entry[2]
+                if expiration is None:
+                    continue
+                if expiration <= now:
+                    pending += 1
+                elif expiration <= horizon:
+                    expiring += 1
+            if principal_ids is None:
+                principal_ids = list(self._principal_ids)
+            principals = {principal_id: self.countForPrincipalId(principal_id)
+                          for principal_id in principal_ids}
+            return utility.TokenStats(
+                len(self), kinds, pending, expiring, principals)
+
+    def iterExpiringBetween(self, start=None, end=None):
+        with self._lock:
+            expiring = sorted(
+                (entry for entry in self._locks.values()
+                 if entry[2] is not None and
+                 (start is None or entry[2] >= start) and
+                 (end is None or entry[2] < end)),
+                key=lambda entry: entry[2])
+        for entry in expiring:
+            yield entry[0]
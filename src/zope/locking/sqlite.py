@@ -0,0 +1,652 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A token utility that keeps its tokens in an SQLite database.
+
+`SQLiteTokenUtility` keeps the tokens of several processes on one host in a
+shared SQLite file, in WAL mode, so that locking and unlocking does not
+write to the object database at all.  The changes of a transaction are
+written in an SQLite transaction, committed or rolled back along with it.
+
+Only what the indexes need is stored: the key reference of the object and
+of its ancestors, the class of the token, its principals, when it started
+and when it expires.  Tokens are made again from that in every transaction,
+so anything else kept on a token, such as its annotations, is not shared.
+"""
+
+import contextlib
+import datetime
+import importlib
+import itertools
+import sqlite3
+import threading
+import time
+
+import transaction.interfaces
+from zope.keyreference.interfaces import IKeyReference
+from zope.location import Location
+
+from zope import interface
+from zope.locking import events
+from zope.locking import interfaces
+from zope.locking import utility
+from zope.locking import utils
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    -- never reused, so that a row is not taken for an earlier one
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    -- the key reference of the object, as its `keys` dump it
+    key TEXT NOT NULL UNIQUE,
+    -- the keys of the object and its ancestors, root first, each ending
+    -- with a newline
+    path TEXT NOT NULL,
+    class TEXT NOT NULL,
+    deep INTEGER NOT NULL,
+    -- microseconds since the epoch
+    started INTEGER NOT NULL,
+    -- when the token expires or ended, or NULL
+    expiration INTEGER
+);
+CREATE INDEX IF NOT EXISTS tokens_path ON tokens (path);
+CREATE INDEX IF NOT EXISTS tokens_expiration ON tokens (expiration);
+CREATE TABLE IF NOT EXISTS principals (
+    principal_id TEXT NOT NULL,
+    token INTEGER NOT NULL REFERENCES tokens (id) ON DELETE CASCADE,
+    PRIMARY KEY (principal_id, token)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS principals_token ON principals (token);
+"""
+
+_COLUMNS = 'tokens.id, key, class, deep, started, expiration'
+
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# the most keys to look up in one statement
+_BATCH = 500
+
+
+class ConflictError(transaction.interfaces.TransientError):
+    """The SQLite database was busy; the transaction may be retried."""
+
+
+def _dumpTime(value):
+    if value is None:
+        return None
+    return (value - utility._EPOCH) // _ONE_MICROSECOND
+
+
+def _loadTime(value):
+    if value is None:
+        return None
+    return utility._EPOCH + value * _ONE_MICROSECOND
+
+
+def _dumpClass(cls):
+    return '%s.%s' % (cls.__module__, cls.__qualname__)
+
+
+_classes = {}
+
+
+def _loadClass(name):
+    cls = _classes.get(name)
+    if cls is None:
+        module, qualname = name.rsplit('.', 1)
+        cls = _classes[name] = getattr(importlib.import_module(module),
+                                       qualname)
+    return cls
+
+
+def _getClassKind(cls):
+    for kind in utility._KINDS:
+        if kind.implementedBy(cls):
+            return kind
+
+
+def _isActive(expiration, now):
+    return expiration is None or expiration > now
+
+
+class PersistentKeys:
+    """Keys for the key references of persistent objects.
+
+    The key of an object is the name of its database and its oid.
+    `get_connection` is called for the ZODB connection that objects are
+    loaded from.
+    """
+
+    def __init__(self, get_connection):
+        self.get_connection = get_connection
+
+    def dump(self, key_ref):
+        obj = key_ref()
+        return '%s:%s' % (obj._p_jar.db().database_name, obj._p_oid.hex())
+
+    def load(self, key):
+        database_name, oid = key.rsplit(':', 1)
+        connection = self.get_connection().get_connection(database_name)
+        try:
+            return connection.get(bytes.fromhex(oid))
+        except KeyError:
+            return None
+
+
+class _DataManager:
+    """the SQLite transaction of a utility in a transaction.
+
+    SQLite cannot prepare a commit, so it commits in `tpc_vote`, after the
+    resources that can, as other one-phase resources do.
+    """
+
+    def __init__(self, utility, connection, transaction):
+        self.utility = utility
+        self.connection = connection
+        self.transaction = transaction
+        self.transaction_manager = utility.transaction_manager
+        # row id: token, so that each row makes one token per transaction
+        self.tokens = {}
+        self._savepoints = itertools.count()
+
+    def execute(self, statement, parameters=(), write=False):
+        try:
+            if not self.connection.in_transaction:
+                self.connection.execute(
+                    'BEGIN IMMEDIATE' if write else 'BEGIN')
+            return self.connection.execute(statement, parameters)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                raise ConflictError(str(e)) from e
+            raise
+
+    def _close(self, statement):
+        if self.connection.in_transaction:
+            self.connection.execute(statement)
+        self.tokens.clear()
+        self.utility._finish(self)
+
+    # IDataManager
+
+    def abort(self, transaction):
+        self._close('ROLLBACK')
+
+    def tpc_begin(self, transaction):
+        pass
+
+    def commit(self, transaction):
+        pass
+
+    def tpc_vote(self, transaction):
+        try:
+            self._close('COMMIT')
+        except sqlite3.OperationalError as e:
+            raise ConflictError(str(e)) from e
+
+    def tpc_finish(self, transaction):
+        pass
+
+    def tpc_abort(self, transaction):
+        self._close('ROLLBACK')
+
+    def sortKey(self):
+        return '~zope.locking.sqlite:%s' % (self.utility.path,)
+
+    # ISavepointDataManager
+
+    def savepoint(self):
+        name = 'zope_locking_%d' % next(self._savepoints)
+        self.execute('SAVEPOINT ' + name)
+        return _Savepoint(self, name)
+
+
+class _Savepoint:
+
+    def __init__(self, data_manager, name):
+        self.data_manager = data_manager
+        self.name = name
+
+    def rollback(self):
+        data_manager = self.data_manager
+        data_manager.execute('ROLLBACK TO ' + self.name)
+        # the tokens made since may no longer match their rows
+        data_manager.tokens.clear()
+
+
+@interface.implementer(interfaces.ITokenUtility)
+class SQLiteTokenUtility(Location):
+    """A token utility that keeps its tokens in an SQLite database.
+
+    `path` is the database file, `keys` turns the key references of objects
+    into the strings stored (`dump`) and back into objects (`load`), and
+    the utility joins the transactions of `transaction_manager`.  Each
+    thread has its own connection to the database.
+    """
+
+    # as for TokenUtility
+    cleanup_limit = 10
+
+    def __init__(self, path, keys, transaction_manager, timeout=10.0):
+        self.path = path
+        self.keys = keys
+        self.transaction_manager = transaction_manager
+        self.timeout = timeout
+        self._local = threading.local()
+        with contextlib.closing(self._connect()) as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self.path, timeout=self.timeout, isolation_level=None,
+            check_same_thread=False)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA foreign_keys = ON')
+        return connection
+
+    def _join(self):
+        """return the data manager of the current transaction"""
+        transaction = self.transaction_manager.get()
+        local = self._local
+        data_manager = getattr(local, 'data_manager', None)
+        if data_manager is None or data_manager.transaction is not transaction:
+            connection = getattr(local, 'connection', None)
+            if connection is None:
+                connection = local.connection = self._connect()
+            data_manager = _DataManager(self, connection, transaction)
+            transaction.join(data_manager)
+            local.data_manager = data_manager
+        return data_manager
+
+    def _finish(self, data_manager):
+        if getattr(self._local, 'data_manager', None) is data_manager:
+            del self._local.data_manager
+
+    def _execute(self, statement, parameters=(), write=False):
+        return self._join().execute(statement, parameters, write)
+
+    # keys and paths
+
+    def _dumpKey(self, key_ref):
+        key = self.keys.dump(key_ref)
+        if '\n' in key:
+            raise ValueError('keys may not contain newlines', key)
+        return key
+
+    def _getKey(self, token):
+        return self._dumpKey(utility._getKeyReference(token))
+
+    def _getPath(self, obj, key_ref=None):
+        return tuple(self._dumpKey(ref) for ref in utility._getPath(
+            obj, key_ref))
+
+    # tokens
+
+    def _makeToken(self, row, context=None):
+        """return the token of a row of the tokens table"""
+        data_manager = self._join()
+        token_id, key, class_name, deep, started, expiration = row
+        token = data_manager.tokens.get(token_id)
+        if token is not None:
+            return token
+        if context is None:
+            context = self.keys.load(key)
+            if context is None:
+                return None
+        cls = _loadClass(class_name)
+        token = cls.__new__(cls)
+        token.context = token.__parent__ = context
+        token._utility = self
+        token._started = _loadTime(started)
+        token._principal_ids = frozenset(
+            principal_id for principal_id, in data_manager.execute(
+                'SELECT principal_id FROM principals WHERE token = ?',
+                (token_id,)))
+        if expiration is not None:
+            token._expiration = _loadTime(expiration)
+        if deep:
+            token._deep = True
+        token._v_sqlite_id = token_id
+        data_manager.tokens[token_id] = token
+        return token
+
+    def _iterTokens(self, rows, limit=None):
+        tokens = (self._makeToken(row) for row in rows)
+        return itertools.islice(
+            (token for token in tokens if token is not None), limit)
+
+    def _getRow(self, key):
+        return self._execute(
+            'SELECT %s FROM tokens WHERE key = ?' % _COLUMNS, (key,)
+        ).fetchone()
+
+    # registration
+
+    def _check(self, token):
+        """check that token may be registered, as `TokenUtility._check`
+        does.
+
+        Returns the key of its object, the current row for the key or None,
+        whether that row is the token's, and the path of the object.
+        """
+        assert interfaces.IToken.providedBy(token)
+        if token.utility is not None and token.utility is not self:
+            raise ValueError('Lock is already registered with another utility')
+        key_ref = utility._getKeyReference(token)
+        key = self._dumpKey(key_ref)
+        current = self._getRow(key)
+        # only a token made in this transaction is known to be its row's
+        is_current = (current is not None and
+                      self._join().tokens.get(current[0]) is token)
+        path = self._getPath(token.context, key_ref)
+        if not is_current:
+            now = _dumpTime(utils.now())
+            if current is not None and _getClassKind(
+                    _loadClass(current[2])).isOrExtends(
+                        interfaces.IEndable) and _isActive(current[5], now):
+                raise interfaces.RegistrationError(token)
+            for start in range(0, len(path) - 1, _BATCH):
+                ancestors = path[start:min(start + _BATCH, len(path) - 1)]
+                if self._execute(
+                        'SELECT 1 FROM tokens WHERE deep AND key IN (%s) '
+                        'AND (expiration IS NULL OR expiration > ?) '
+                        'LIMIT 1' % ', '.join('?' * len(ancestors)),
+                        ancestors + (now,)).fetchone():
+                    raise interfaces.RegistrationError(token)
+            if getattr(token, 'deep', False):
+                # the paths of the descendants start with the path
+                prefix = ''.join(k + '\n' for k in path)
+                if self._execute(
+                        'SELECT 1 FROM tokens WHERE path > ? AND path < ? '
+                        'AND (expiration IS NULL OR expiration > ?) '
+                        'LIMIT 1', (prefix, prefix[:-1] + '\x0b', now)
+                ).fetchone():
+                    raise interfaces.RegistrationError(token)
+        return key, current, is_current, path
+
+    def _setPrincipals(self, token_id, old, new):
+        for principal_id in old.difference(new):
+            self._execute(
+                'DELETE FROM principals WHERE principal_id = ? AND token = ?',
+                (principal_id, token_id), write=True)
+        for principal_id in new.difference(old):
+            self._execute(
+                'INSERT INTO principals (principal_id, token) VALUES (?, ?)',
+                (principal_id, token_id), write=True)
+
+    def _index(self, token, key, current, is_current, path):
+        """index a token that has passed `_check`.
+
+        Returns True if the token is new to the utility.
+        """
+        if token.utility is None:
+            token.utility = self
+        entry = utility._makeEntry(token)
+        expiration = _dumpTime(entry[2])
+        if is_current:
+            token_id = current[0]
+            if entry[3].isOrExtends(interfaces.IEndable) and token.ended:
+                self._execute('DELETE FROM tokens WHERE id = ?', (token_id,),
+                              write=True)
+                self._join().tokens.pop(token_id, None)
+            else:
+                self._execute(
+                    'UPDATE tokens SET expiration = ? WHERE id = ?',
+                    (expiration, token_id), write=True)
+                old = frozenset(principal_id for principal_id, in
+                                self._execute(
+                                    'SELECT principal_id FROM principals '
+                                    'WHERE token = ?', (token_id,)))
+                self._setPrincipals(token_id, old, token.principal_ids)
+            return False
+        if current is not None:
+            self._execute('DELETE FROM tokens WHERE id = ?', (current[0],),
+                          write=True)
+            self._join().tokens.pop(current[0], None)
+        token_id = self._execute(
+            'INSERT INTO tokens (key, path, class, deep, started, expiration) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (key, ''.join(k + '\n' for k in path), _dumpClass(type(token)),
+             int(entry[4]), _dumpTime(token.started), expiration),
+            write=True).lastrowid
+        self._setPrincipals(token_id, frozenset(), token.principal_ids)
+        token._v_sqlite_id = token_id
+        self._join().tokens[token_id] = token
+        return True
+
+    def reindexMoved(self, obj, old_parent):
+        paths = utility._getMovedPaths(obj, old_parent)
+        if paths is None or paths[0] == paths[1]:
+            return
+        old_prefix, new_prefix = (
+            ''.join(self._dumpKey(key_ref) + '\n' for key_ref in path)
+            for path in paths)
+        # the object's path and those starting with it
+        bounds = (old_prefix, old_prefix[:-1] + '\x0b')
+        if self._execute(
+                'SELECT 1 FROM tokens WHERE path >= ? AND path < ? LIMIT 1',
+                bounds).fetchone():
+            self._execute(
+                'UPDATE tokens SET path = ? || substr(path, ?) '
+                'WHERE path >= ? AND path < ?',
+                (new_prefix, len(old_prefix) + 1) + bounds, write=True)
+
+    def _cleanup(self, max_tokens=None, deadline=None):
+        """clean out expired tokens, as `TokenUtility._cleanup` does."""
+        count = 0
+        now = _dumpTime(utils.now())
+        while max_tokens is None or count < max_tokens:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            batch = _BATCH if max_tokens is None else min(
+                _BATCH, max_tokens - count)
+            expired = [token_id for token_id, in self._execute(
+                'SELECT id FROM tokens WHERE expiration <= ? '
+                'ORDER BY expiration LIMIT ?', (now, batch))]
+            if not expired:
+                break
+            self._execute(
+                'DELETE FROM tokens WHERE id IN (%s)' % ', '.join(
+                    '?' * len(expired)), expired, write=True)
+            count += len(expired)
+        return count
+
+    def reap(self, max_tokens=None, max_seconds=None):
+        deadline = None
+        if max_seconds is not None:
+            deadline = time.monotonic() + max_seconds
+        return self._cleanup(max_tokens, deadline)
+
+    def register(self, token):
+        checked = self._check(token)
+        is_new = self._index(token, *checked)
+        self._cleanup(self.cleanup_limit)
+        if is_new:
+            events.notify(interfaces.TokenStartedEvent(token))
+        return token
+
+    def registerMany(self, tokens):
+        tokens = list(tokens)
+        checked = []
+        seen = {}
+        for token in tokens:
+            key, current, is_current, path = self._check(token)
+            utility._checkOnce(seen, key, token)
+            checked.append((token, key, current, is_current, path))
+        utility._checkBatch([(token, key, current, path)
+                             for token, key, current, is_current, path
+                             in checked])
+        started = [args[0] for args in checked if self._index(*args)]
+        self._cleanup(self.cleanup_limit)
+        for token in started:
+            events.notify(interfaces.TokenStartedEvent(token))
+        return tokens
+
+    def _checkRegistered(self, tokens):
+        tokens = list(tokens)
+        seen = set()
+        for token in tokens:
+            if not interfaces.IEndable.providedBy(token):
+                raise TypeError('token is not endable', token)
+            if token.utility is not self:
+                raise ValueError('token is not registered with this utility')
+            if token.ended:
+                raise interfaces.EndedError(token)
+            if id(token) in seen:
+                raise ValueError('token is given more than once', token)
+            seen.add(id(token))
+        return tokens
+
+    def endMany(self, tokens):
+        tokens = self._checkRegistered(tokens)
+        for token in tokens:
+            token.end()
+        return tokens
+
+    def refreshMany(self, tokens, duration):
+        tokens = self._checkRegistered(tokens)
+        if duration is not None:
+            if not isinstance(duration, datetime.timedelta):
+                raise ValueError('duration must be datetime.timedelta')
+            if duration < datetime.timedelta():
+                raise ValueError('duration may not be negative')
+        for token in tokens:
+            token.remaining_duration = duration
+        return tokens
+
+    # lookups
+
+    def get(self, obj, default=None):
+        row = self._getRow(self._dumpKey(IKeyReference(obj)))
+        if row is not None and _isActive(row[5], _dumpTime(utils.now())):
+            return self._makeToken(row, obj)
+        return default
+
+    def query(self, obj, default=None):
+        token = self.get(obj)
+        if token is not None:
+            return utility.TokenInfo(
+                token, token.principal_ids, token.expiration,
+                utility._getKind(token))
+        return default
+
+    def isLocked(self, obj):
+        row = self._getRow(self._dumpKey(IKeyReference(obj)))
+        return row is not None and _isActive(row[5], _dumpTime(utils.now()))
+
+    def getMany(self, objects):
+        objects = list(objects)
+        keys = {}
+        for obj in objects:
+            keys.setdefault(self._dumpKey(IKeyReference(obj)), obj)
+        now = _dumpTime(utils.now())
+        rows = {}
+        keys_list = list(keys)
+        for start in range(0, len(keys_list), _BATCH):
+            batch = keys_list[start:start + _BATCH]
+            for row in self._execute(
+                    'SELECT %s FROM tokens WHERE key IN (%s)' % (
+                        _COLUMNS, ', '.join('?' * len(batch))), batch):
+                if _isActive(row[5], now):
+                    rows[row[1]] = row
+        result = {}
+        for obj in objects:
+            row = rows.get(self._dumpKey(IKeyReference(obj)))
+            result[obj] = None if row is None else self._makeToken(row, obj)
+        return result
+
+    def getEffective(self, obj, default=None):
+        key_refs = utility._getPath(obj)
+        path = tuple(self._dumpKey(key_ref) for key_ref in key_refs)
+        now = _dumpTime(utils.now())
+        rows = {}
+        for start in range(0, len(path), _BATCH):
+            batch = path[start:start + _BATCH]
+            for row in self._execute(
+                    'SELECT %s FROM tokens WHERE key IN (%s)' % (
+                        _COLUMNS, ', '.join('?' * len(batch))), batch):
+                rows[row[1]] = row
+        row = rows.get(path[-1])
+        if row is not None and _isActive(row[5], now):
+            return self._makeToken(row, obj)
+        for key_ref, key in zip(reversed(key_refs[:-1]),
+                                reversed(path[:-1])):
+            row = rows.get(key)
+            if row is not None and row[3] and _isActive(row[5], now):
+                return self._makeToken(row, key_ref())
+        return default
+
+    def iterForPrincipalId(self, principal_id, start=None, limit=None):
+        # ordered by the ids of the rows
+        rows = self._execute(
+            'SELECT %s FROM principals JOIN tokens ON token = tokens.id '
+            'WHERE principal_id = ? AND token > ? '
+            'AND (expiration IS NULL OR expiration > ?) ORDER BY token' % (
+                _COLUMNS,),
+            (principal_id, self._startId(start),
+             _dumpTime(utils.now()))).fetchall()
+        yield from self._iterTokens(rows, limit)
+
+    def _startId(self, start):
+        if start is None:
+            return 0
+        return start._v_sqlite_id
+
+    def countForPrincipalId(self, principal_id):
+        return self._execute(
+            'SELECT count(*) FROM principals WHERE principal_id = ?',
+            (principal_id,)).fetchone()[0]
+
+    def __iter__(self, start=None, limit=None):
+        rows = self._execute(
+            'SELECT %s FROM tokens WHERE id > ? '
+            'AND (expiration IS NULL OR expiration > ?) ORDER BY id' % (
+                _COLUMNS,),
+            (self._startId(start), _dumpTime(utils.now()))).fetchall()
+        yield from self._iterTokens(rows, limit)
+
+    def __len__(self):
+        return self._execute('SELECT count(*) FROM tokens').fetchone()[0]
+
+    def __bool__(self):
+        # the utility is there even when it has no tokens
+        return True
+
+    def stats(self, principal_ids=(), expiring_within=utility._ONE_HOUR):
+        now = utils.now()
+        kinds = dict.fromkeys(utility._KINDS, 0)
+        for class_name, count in self._execute(
+                'SELECT class, count(*) FROM tokens GROUP BY class'):
+            kinds[_getClassKind(_loadClass(class_name))] += count
+        pending, expiring = self._execute(
+            'SELECT count(expiration <= :now OR NULL), '
+            'count(expiration > :now AND expiration <= :horizon OR NULL) '
+            'FROM tokens WHERE expiration IS NOT NULL',
+            {'now': _dumpTime(now),
+             'horizon': _dumpTime(now + expiring_within)}).fetchone()
+        if principal_ids is None:
+            principals = dict(self._execute(
+                'SELECT principal_id, count(*) FROM principals '
+                'GROUP BY principal_id'))
+        else:
+            principals = {principal_id: self.countForPrincipalId(principal_id)
+                          for principal_id in principal_ids}
+        return utility.TokenStats(
+            len(self), kinds, pending, expiring, principals)
+
+    def iterExpiringBetween(self, start=None, end=None):
+        rows = self._execute(
+            'SELECT %s FROM tokens WHERE expiration >= ? AND expiration < ? '
+            'ORDER BY expiration' % (_COLUMNS,),
+            (_dumpTime(start) if start is not None else -2 ** 63,
+             _dumpTime(end) if end is not None else 2 ** 63 - 1)).fetchall()
+        yield from self._iterTokens(rows)
@@ -13,6 +13,7 @@
 ##############################################################################
 
 import functools
+import weakref
 
 import zope.app.appsetup.testlayer
 import zope.component
@@ -52,7 +53,7 @@ class DemoKeyReference:
         return self.context
 
     def __hash__(self):
-        return (self.key_type_id, self._id)
+        return hash((self.key_type_id, self._id))
 
     def __eq__(self, other):
         return (self.key_type_id, self._id) == (other.key_type_id, other._id)
@@ -61,4 +62,21 @@ class DemoKeyReference:
         return (self.key_type_id, self._id) < (other.key_type_id, other._id)
 
 
+class DemoKeys:
+    """keys for `DemoKeyReference`s, for `sqlite.SQLiteTokenUtility`.
+
+    Objects are found again among the objects whose keys were dumped.
+    """
+
+    def __init__(self):
+        self.objects = weakref.WeakValueDictionary()
+
+    def dump(self, key_ref):
+        self.objects[key_ref._id] = key_ref()
+        return 'demo:%d' % (key_ref._id,)
+
+    def load(self, key):
+        return self.objects.get(int(key.split(':')[1]))
+
+
 layer = zope.app.appsetup.testlayer.ZODBLayer(zope.locking)
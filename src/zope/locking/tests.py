@@ -13,14 +13,52 @@
 ##############################################################################
 
 import doctest
+import os
 import re
+import shutil
+import tempfile
 import unittest
 
+import transaction
 import zope.testing.renormalizing
 
+import zope.locking.memory
+import zope.locking.sqlite
 import zope.locking.testing
 
 
+# examples that only the persistent token utility passes
+ZODB = doctest.register_optionflag('ZODB')
+
+
+class MemoryParser(doctest.DocTestParser):
+    """skip the examples marked ZODB, to run them with other token utilities
+    """
+
+    def parse(self, string, name='<string>'):
+        pieces = super().parse(string, name)
+        for piece in pieces:
+            if isinstance(piece, doctest.Example) and piece.options.get(ZODB):
+                piece.options[doctest.SKIP] = True
+        return pieces
+
+
+def setUpMemoryUtility(test):
+    test.globs['util'] = zope.locking.memory.MemoryTokenUtility()
+
+
+def setUpSQLiteUtility(test):
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+    test.globs['util'] = zope.locking.sqlite.SQLiteTokenUtility(
+        os.path.join(test.globs['tmpdir'], 'locks.db'),
+        zope.locking.testing.DemoKeys(), transaction.TransactionManager())
+
+
+def tearDownSQLiteUtility(test):
+    test.globs['util'].transaction_manager.abort()
+    shutil.rmtree(test.globs['tmpdir'])
+
+
 normalizer = zope.testing.renormalizing.RENormalizing([
     (re.compile(r'datetime\.timedelta\(0, (.*)\)'),
      r'datetime.timedelta(seconds=\1)'),
@@ -46,6 +84,19 @@ def test_suite():
                 get_connection=get_connection,
                 get_db=get_db
             )),
+        doctest.DocFileSuite(
+            'README.rst',
+            optionflags=doctest.IGNORE_EXCEPTION_DETAIL,
+            checker=normalizer,
+            parser=MemoryParser(),
+            setUp=setUpMemoryUtility),
+        doctest.DocFileSuite(
+            'README.rst',
+            optionflags=doctest.IGNORE_EXCEPTION_DETAIL,
+            checker=normalizer,
+            parser=MemoryParser(),
+            setUp=setUpSQLiteUtility,
+            tearDown=tearDownSQLiteUtility),
         doctest.DocFileSuite(
             'annoying.rst',
             optionflags=doctest.IGNORE_EXCEPTION_DETAIL,
@@ -62,6 +113,46 @@ def test_suite():
                 get_connection=get_connection,
                 get_db=get_db
             )),
+        doctest.DocFileSuite(
+            'concurrency.rst',
+            optionflags=doctest.IGNORE_EXCEPTION_DETAIL,
+            checker=normalizer,
+            globs=dict(
+                get_connection=get_connection,
+                get_db=get_db
+            )),
+        doctest.DocFileSuite(
+            'events.rst',
+            optionflags=doctest.IGNORE_EXCEPTION_DETAIL,
+            checker=normalizer,
+            globs=dict(
+                get_connection=get_connection,
+                get_db=get_db
+            )),
+        doctest.DocFileSuite(
+            'instrumentation.rst',
+            optionflags=doctest.IGNORE_EXCEPTION_DETAIL | doctest.ELLIPSIS,
+            checker=normalizer,
+            globs=dict(
+                get_connection=get_connection,
+                get_db=get_db
+            )),
+        doctest.DocFileSuite(
+            'memory.rst',
+            optionflags=doctest.IGNORE_EXCEPTION_DETAIL,
+            checker=normalizer),
+        doctest.DocFileSuite(
+            'sqlite.rst',
+            optionflags=doctest.IGNORE_EXCEPTION_DETAIL | doctest.ELLIPSIS,
+            checker=normalizer),
+        doctest.DocFileSuite(
+            'integrity.rst',
+            optionflags=doctest.IGNORE_EXCEPTION_DETAIL,
+            checker=normalizer,
+            globs=dict(
+                get_connection=get_connection,
+                get_db=get_db
+            )),
     ))
     suite.layer = layer
     return suite
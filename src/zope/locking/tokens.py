@@ -18,8 +18,8 @@ import functools
 import persistent
 from BTrees.OOBTree import OOBTree
 
-from zope import event
 from zope import interface
+from zope.locking import events
 from zope.locking import interfaces
 from zope.locking import utils
 
@@ -28,7 +28,53 @@ NO_DURATION = datetime.timedelta()
 
 
 class AnnotationsMapping(OOBTree):
-    """a class on which security settings may be hung."""
+    """a class on which security settings may be hung.
+
+    Tokens create their mapping when it is first asked for, and only keep it
+    once something is stored in it.
+    """
+
+    # BTrees do not pickle their __dict__, and setting a normal attribute
+    # would mark the mapping as changed, so the parent is kept in a volatile
+    # attribute; the token sets it whenever it hands the mapping out.
+
+    @property
+    def __parent__(self):
+        return getattr(self, '_v_parent', None)
+
+    @__parent__.setter
+    def __parent__(self, value):
+        self._v_parent = value
+
+    def _attach(self):
+        token = self.__parent__
+        if token is not None and token._annotations is not self:
+            token._annotations = self
+
+    def __setitem__(self, key, value):
+        self._attach()
+        super().__setitem__(key, value)
+
+    def insert(self, key, value):
+        self._attach()
+        return super().insert(key, value)
+
+    def setdefault(self, key, default):
+        self._attach()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._attach()
+        super().update(*args, **kwargs)
+
+
+def _getSortKey(token):
+    jar = token._p_jar
+    if jar is None:
+        # tokens outside of a database, such as those of a
+        # MemoryTokenUtility, come after the others, by identity
+        return (1, '', id(token))
+    return (0, jar.db().database_name, token._p_oid)
 
 
 @functools.total_ordering
@@ -36,11 +82,85 @@ class Token(persistent.Persistent):
 
     def __init__(self, target):
         self.context = self.__parent__ = target
-        self.annotations = AnnotationsMapping()
-        self.annotations.__parent__ = self  # for security.
+
+    _annotations = None
+
+    @property
+    def annotations(self):
+        annotations = self._annotations
+        if annotations is None:
+            # not stored until something is put in it
+            annotations = getattr(self, '_v_annotations', None)
+            if annotations is None:
+                annotations = self._v_annotations = AnnotationsMapping()
+        annotations.__parent__ = self  # for security.
+        return annotations
+
+    # Tokens are pickled compactly, as a tuple of the values of these
+    # attributes followed by a dict of anything else.  Attributes that have
+    # their class default are stored as None, and trailing Nones are dropped,
+    # so the usual token does not store any attribute name.  The order must
+    # never change; new attributes go at the end.
+    _state_attributes = (
+        'context', '_utility', '_started', '_principal_ids', '_path',
+        '_key_ref', '_expiration', '_ended', '_deep', '_annotations',
+        '_duration')
+
+    def __getstate__(self):
+        extra = super().__getstate__()
+        cls = type(self)
+        values = [extra.pop(name, None) for name in self._state_attributes]
+        for i, name in enumerate(self._state_attributes):
+            if values[i] is getattr(cls, name, None):
+                values[i] = None
+        principal_ids = values[3]
+        if principal_ids is not None:
+            values[3] = utils.packPrincipalIds(principal_ids) or None
+        path, key_ref = values[4:6]
+        if path and key_ref is path[-1]:
+            values[5] = None
+        if extra.get('__parent__', self) is values[0]:
+            del extra['__parent__']
+        while values and values[-1] is None:
+            values.pop()
+        return tuple(values) + (extra or None,)
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            values, extra = state[:-1], state[-1]
+            state = {name: value
+                     for name, value in zip(self._state_attributes, values)
+                     if value is not None}
+            if '_principal_ids' in state:
+                state['_principal_ids'] = utils.unpackPrincipalIds(
+                    state['_principal_ids'])
+            if '_path' in state and '_key_ref' not in state:
+                state['_key_ref'] = state['_path'][-1]
+            if 'context' in state:
+                state['__parent__'] = state['context']
+            if extra:
+                state.update(extra)
+        elif isinstance(state, dict) and 'annotations' in state:
+            # tokens pickled by older versions always have a mapping
+            state = dict(state)
+            state['_annotations'] = state.pop('annotations')
+        super().__setstate__(state)
 
     _principal_ids = frozenset()
 
+    # the key reference of the context, set by the utility on registration
+    _key_ref = None
+
+    # the key references of the context and its ancestors, root first, also
+    # set by the utility on registration
+    _path = None
+
+    _deep = False
+
+    @property
+    def deep(self):
+        return self._deep
+
     @property
     def principal_ids(self):
         return self._principal_ids
@@ -70,22 +190,39 @@ class Token(persistent.Persistent):
             assert self._started is None
             self._started = utils.now()
 
+    # Tokens are ordered by (database name, oid).  The index sets compare
+    # tokens all the time, and nearly always tokens of the same connection,
+    # so the oids are enough and the database is only looked up otherwise.
+    # Only _p_ attributes are used, so ghosts are not loaded.  Tokens that
+    # are not in a database compare, and hash, by identity; the token utility
+    # adds tokens to its database before it hashes them.
+
     def __eq__(self, other):
-        return (
-            (self._p_jar.db().database_name, self._p_oid) ==
-            (other._p_jar.db().database_name, other._p_oid))
+        jar = self._p_jar
+        if jar is not None and jar is other._p_jar:
+            return self._p_oid == other._p_oid
+        return _getSortKey(self) == _getSortKey(other)
 
     def __lt__(self, other):
-        return (
-            (self._p_jar.db().database_name, self._p_oid) <
-            (other._p_jar.db().database_name, other._p_oid))
+        jar = self._p_jar
+        if jar is not None and jar is other._p_jar:
+            return self._p_oid < other._p_oid
+        return _getSortKey(self) < _getSortKey(other)
+
+    def __hash__(self):
+        oid = self._p_oid
+        if oid is None:
+            return object.__hash__(self)
+        return hash(oid)
 
 
 class EndableToken(Token):
 
-    def __init__(self, target, duration=None):
+    def __init__(self, target, duration=None, deep=False):
         super().__init__(target)
         self._duration = duration
+        if deep:
+            self._deep = True
 
     @property
     def utility(self):
@@ -128,7 +265,7 @@ class EndableToken(Token):
         self._expiration = value
         if old != self._expiration:
             self.utility.register(self)
-            event.notify(interfaces.ExpirationChangedEvent(self, old))
+            events.notify(interfaces.ExpirationChangedEvent(self, old))
 
     @property
     def duration(self):
@@ -156,7 +293,7 @@ class EndableToken(Token):
                 self._expiration = self._started + value
             if old != self._expiration:
                 self.utility.register(self)
-                event.notify(interfaces.ExpirationChangedEvent(self, old))
+                events.notify(interfaces.ExpirationChangedEvent(self, old))
 
     @property
     def remaining_duration(self):
@@ -185,7 +322,7 @@ class EndableToken(Token):
             self._expiration = utils.now() + value
         if old != self._expiration:
             self.utility.register(self)
-            event.notify(interfaces.ExpirationChangedEvent(self, old))
+            events.notify(interfaces.ExpirationChangedEvent(self, old))
 
     _ended = None
 
@@ -204,23 +341,23 @@ class EndableToken(Token):
             raise interfaces.EndedError
         self._ended = utils.now()
         self.utility.register(self)
-        event.notify(interfaces.TokenEndedEvent(self))
+        events.notify(interfaces.TokenEndedEvent(self))
 
 
 @interface.implementer(interfaces.IExclusiveLock)
 class ExclusiveLock(EndableToken):
 
-    def __init__(self, target, principal_id, duration=None):
+    def __init__(self, target, principal_id, duration=None, deep=False):
         self._principal_ids = frozenset((principal_id,))
-        super().__init__(target, duration)
+        super().__init__(target, duration, deep)
 
 
 @interface.implementer(interfaces.ISharedLock)
 class SharedLock(EndableToken):
 
-    def __init__(self, target, principal_ids, duration=None):
+    def __init__(self, target, principal_ids, duration=None, deep=False):
         self._principal_ids = frozenset(principal_ids)
-        super().__init__(target, duration)
+        super().__init__(target, duration, deep)
 
     def add(self, principal_ids):
         if self.ended:
@@ -229,7 +366,7 @@ class SharedLock(EndableToken):
         self._principal_ids = self._principal_ids.union(principal_ids)
         if old != self._principal_ids:
             self.utility.register(self)
-            event.notify(interfaces.PrincipalsChangedEvent(self, old))
+            events.notify(interfaces.PrincipalsChangedEvent(self, old))
 
     def remove(self, principal_ids):
         if self.ended:
@@ -243,7 +380,7 @@ class SharedLock(EndableToken):
         else:
             return
         # principals changed if you got here
-        event.notify(interfaces.PrincipalsChangedEvent(self, old))
+        events.notify(interfaces.PrincipalsChangedEvent(self, old))
 
 
 @interface.implementer(interfaces.IEndableFreeze)
@@ -0,0 +1,330 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""BTree classes for the token utility indexes"""
+
+import collections
+import datetime
+import functools
+import hashlib
+import heapq
+import itertools
+
+import persistent
+from BTrees.Interfaces import BTreesConflictError
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOSet
+from BTrees.OOBTree import OOTreeSet
+
+
+##############################################################################
+# Conflict resolution for sets of tokens
+##############################################################################
+
+# When ZODB resolves a conflict, persistent objects in the states are
+# PersistentReference instances, which refuse to be ordered.  Tokens order
+# themselves by (database name, oid), so as long as every token in a set is in
+# the same database (and the token utility puts them in its own) we can order
+# the references by oid and let BTrees do the real work.
+
+
+@functools.total_ordering
+class _ResolvingKey:
+
+    __slots__ = ('ref',)
+
+    def __init__(self, ref):
+        if getattr(ref, 'database_name', None) is not None:
+            # a cross-database reference: we can't know how it sorts
+            raise BTreesConflictError(-1, -1, -1, 1)
+        self.ref = ref
+
+    def __eq__(self, other):
+        return self.ref.oid == other.ref.oid
+
+    def __lt__(self, other):
+        return self.ref.oid < other.ref.oid
+
+    def __hash__(self):
+        return hash(self.ref.oid)
+
+
+def _wrapBucketState(state):
+    if state is None:
+        return None
+    return (tuple(_ResolvingKey(k) for k in state[0]),) + tuple(state[1:])
+
+
+def _unwrapBucketState(state):
+    if state is None:
+        return None
+    return (tuple(k.ref for k in state[0]),) + tuple(state[1:])
+
+
+def _isInlineTreeState(state):
+    return (state is not None and len(state) == 1 and len(state[0]) == 1 and
+            isinstance(state[0][0], tuple))
+
+
+def _wrapTreeState(state):
+    if _isInlineTreeState(state):
+        return ((_wrapBucketState(state[0][0]),),)
+    return state
+
+
+def _unwrapTreeState(state):
+    if _isInlineTreeState(state):
+        return ((_unwrapBucketState(state[0][0]),),)
+    return state
+
+
+class TokenSet(OOSet):
+    """A bucket of tokens that can resolve conflicting changes"""
+
+    def _p_resolveConflict(self, old, committed, new):
+        return _unwrapBucketState(super()._p_resolveConflict(
+            _wrapBucketState(old),
+            _wrapBucketState(committed),
+            _wrapBucketState(new)))
+
+
+class TokenTreeSet(OOTreeSet):
+    """A set of tokens whose buckets can resolve conflicting changes.
+
+    Concurrent transactions that add and remove different tokens merge, as
+    they do for BTrees of simple keys.
+    """
+
+    _bucket_type = TokenSet
+
+    def _p_resolveConflict(self, old, committed, new):
+        return _unwrapTreeState(super()._p_resolveConflict(
+            _wrapTreeState(old),
+            _wrapTreeState(committed),
+            _wrapTreeState(new)))
+
+
+##############################################################################
+# Sharded trees
+##############################################################################
+
+
+def _digest(data):
+    # crc32 would be faster, but it is linear, so keys that differ in the
+    # same few bits (like oids allocated together) land in the same shard
+    return int.from_bytes(
+        hashlib.blake2b(data, digest_size=4).digest(), 'big')
+
+
+def stableHash(key):
+    """Return a hash of an index key that is the same in every process.
+
+    Python's own hash of strings is randomized per process, so it can't be
+    used to pick a persistent shard.  Key references to persistent objects
+    are hashed by the oid of the object, and tuples by their items.  Other
+    keys fall back to the builtin `hash`, which must then be stable for them.
+    """
+    if isinstance(key, str):
+        return _digest(key.encode('utf-8'))
+    if isinstance(key, bytes):
+        return _digest(key)
+    if isinstance(key, int):
+        return _digest(key.to_bytes(8, 'big', signed=True))
+    if isinstance(key, datetime.datetime):
+        return _digest(key.isoformat().encode('ascii'))
+    if isinstance(key, tuple):
+        return _digest(b''.join(
+            stableHash(item).to_bytes(8, 'big', signed=True)
+            for item in key))
+    # KeyReferenceToPersistent
+    oid = getattr(getattr(key, 'object', None), '_p_oid', None)
+    if oid is not None:
+        return _digest(oid)
+    return hash(key)
+
+
+# how many items getSorted reads past a key it does not need, before it
+# looks the next key up from the root of the tree instead
+_MERGE_GAP = 64
+
+
+def _getSortedFromTree(tree, keys, found):
+    items = item = None
+    for key in keys:
+        if items is not None:
+            skipped = 0
+            while item is not None and item[0] < key:
+                if skipped == _MERGE_GAP:
+                    items = None
+                    break
+                item = next(items, None)
+                skipped += 1
+        if items is None:
+            items = iter(tree.items(key))
+            item = next(items, None)
+        if item is not None and item[0] == key:
+            found[key] = item[1]
+
+
+def getSorted(tree, keys):
+    """Return a dict of the keys found in an OOBTree or ShardedTree.
+
+    `keys` must be sorted and distinct.  Rather than looking every key up
+    from the root, the tree is read in order from the first key on, so keys
+    that are close together in the tree share the buckets on the way; only
+    when the next key is far ahead is it looked up from the root again.
+    """
+    found = {}
+    if isinstance(tree, ShardedTree):
+        by_shard = collections.defaultdict(list)
+        for key in keys:
+            by_shard[tree._shard(key)].append(key)
+        for shard, shard_keys in by_shard.items():
+            _getSortedFromTree(shard, shard_keys, found)
+    else:
+        _getSortedFromTree(tree, keys, found)
+    return found
+
+
+class ShardedTree(persistent.Persistent):
+    """A mapping spread over several independently persisted OOBTrees.
+
+    Each key lives in the shard picked by its `stableHash`, so that
+    transactions changing different keys usually change different trees.
+    Iteration merges the shards in key order.  This object itself never
+    changes after it is created.
+    """
+
+    def __init__(self, shards=16):
+        self._shards = tuple(OOBTree() for i in range(shards))
+
+    def _shard(self, key):
+        return self._shards[stableHash(key) % len(self._shards)]
+
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def __setitem__(self, key, value):
+        self._shard(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._shard(key)[key]
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def __bool__(self):
+        return any(self._shards)
+
+    def minKey(self):
+        keys = [shard.minKey() for shard in self._shards if shard]
+        if not keys:
+            raise ValueError('empty tree')
+        return min(keys)
+
+    def items(self, min=None, max=None, excludemin=False, excludemax=False):
+        return heapq.merge(
+            *[shard.items(min, max, excludemin, excludemax)
+              for shard in self._shards],
+            key=lambda item: item[0])
+
+    def keys(self, min=None, max=None, excludemin=False, excludemax=False):
+        return heapq.merge(*[shard.keys(min, max, excludemin, excludemax)
+                             for shard in self._shards])
+
+    __iter__ = keys
+
+    def values(self, min=None, max=None, excludemin=False, excludemax=False):
+        return (value for key, value in self.items(
+            min, max, excludemin, excludemax))
+
+
+class ShardedSets(persistent.Persistent):
+    """A mapping of keys to sets of tokens, each set spread over the shards.
+
+    Unlike `ShardedTree`, which keeps each key in one shard, this picks the
+    shard by the token, so that transactions adding different tokens under
+    the same key (tokens expiring in the same time slice, for instance)
+    usually change different trees.  The shards map keys to sets of tokens;
+    looking up a key returns a list of its tokens from all the shards.  This
+    object itself never changes after it is created.
+    """
+
+    def __init__(self, shards=16):
+        self._shards = tuple(OOBTree() for i in range(shards))
+
+    def _shard(self, token):
+        oid = getattr(token, '_p_oid', None)
+        return self._shards[
+            stableHash(oid) % len(self._shards) if oid is not None else 0]
+
+    def byShard(self, tokens):
+        """return the tokens grouped by shard, as (shard, tokens) pairs"""
+        groups = {}
+        for token in tokens:
+            shard = self._shard(token)
+            groups.setdefault(id(shard), (shard, []))[1].append(token)
+        return groups.values()
+
+    def get(self, key, default=None):
+        sets = [shard[key] for shard in self._shards if key in shard]
+        if not sets:
+            return default
+        return list(itertools.chain(*sets))
+
+    def __getitem__(self, key):
+        res = self.get(key)
+        if res is None:
+            raise KeyError(key)
+        return res
+
+    def iterTokens(self, key):
+        """iterate over the tokens of key in all the shards, without
+        copying them"""
+        return itertools.chain.from_iterable(
+            shard[key] for shard in self._shards if key in shard)
+
+    def __contains__(self, key):
+        return any(key in shard for shard in self._shards)
+
+    def __len__(self):
+        return sum(1 for key in self.keys())
+
+    def __bool__(self):
+        return any(self._shards)
+
+    def minKey(self):
+        keys = [shard.minKey() for shard in self._shards if shard]
+        if not keys:
+            raise ValueError('empty tree')
+        return min(keys)
+
+    def keys(self, min=None, max=None, excludemin=False, excludemax=False):
+        merged = heapq.merge(*[shard.keys(min, max, excludemin, excludemax)
+                               for shard in self._shards])
+        return (key for key, group in itertools.groupby(merged))
+
+    __iter__ = keys
+
+    def items(self, min=None, max=None, excludemin=False, excludemax=False):
+        """return (key, set) pairs, once for every shard that has the key"""
+        return heapq.merge(
+            *[shard.items(min, max, excludemin, excludemax)
+              for shard in self._shards],
+            key=lambda item: item[0])
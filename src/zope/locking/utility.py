@@ -12,138 +12,933 @@
 #
 ##############################################################################
 
+import collections
+import datetime
+import itertools
+import time
+
 import persistent
 import persistent.interfaces
+from BTrees.Length import Length
 from BTrees.OOBTree import OOBTree
-from BTrees.OOBTree import OOTreeSet
 from zope.keyreference.interfaces import IKeyReference
+from zope.lifecycleevent.interfaces import IObjectMovedEvent
 from zope.location import Location
 
-from zope import event
+from zope import component
 from zope import interface
+from zope.locking import events
+from zope.locking import instrumentation
 from zope.locking import interfaces
+from zope.locking import tokens
+from zope.locking import trees
 from zope.locking import utils
 
 
+def _getKeyReference(token):
+    """return the key reference of the token's context.
+
+    The key reference is stored on the token when it is registered, so that
+    the utility never needs to load the context again to find it.  Tokens
+    registered with older versions of this package do not have it yet.
+    """
+    key_ref = getattr(token, '_key_ref', None)
+    if key_ref is None:
+        key_ref = _adaptKeyReference(token.context)
+    return key_ref
+
+
+@instrumentation.timed('keyref')
+def _adaptKeyReference(obj):
+    return IKeyReference(obj)
+
+
+# The kinds of token the index distinguishes, most specific first.  The
+# index stores the first one that a token provides.
+_KINDS = (
+    interfaces.IExclusiveLock,
+    interfaces.ISharedLock,
+    interfaces.IEndableFreeze,
+    interfaces.IFreeze,
+    interfaces.IEndableToken,
+    interfaces.IToken,
+)
+
+
+def _getKind(token):
+    for kind in _KINDS:
+        if kind.providedBy(token):
+            return kind
+
+
+def _makeEntry(token):
+    """return the `_locks` index entry for a token.
+
+    Entries are tuples of (token, principal ids, expiration, kind, deep), so
+    that the status of a lock can be determined without loading the token.
+    The principal ids are packed by `utils.packPrincipalIds`.
+    If the token has already ended, the time it ended is used as the
+    expiration, so a token is active as long as the expiration is None or in
+    the future.
+    """
+    kind = _getKind(token)
+    if kind.isOrExtends(interfaces.IEndable):
+        expiration = token.ended or token.expiration
+    else:
+        expiration = None
+    return (token, utils.packPrincipalIds(token.principal_ids), expiration,
+            kind, bool(getattr(token, 'deep', False)))
+
+
+def _newKindCounts():
+    return {kind: Length() for kind in _KINDS}
+
+
+def _getEntryKind(entry):
+    if len(entry) > 3:
+        return entry[3]
+    # entries indexed by older versions of this package do not have the kind
+    return _getKind(entry[0])
+
+
+def _isEntryDeep(entry):
+    # entries indexed by older versions of this package are never deep
+    return len(entry) > 4 and entry[4]
+
+
+def _isEntryActive(entry, now):
+    return entry[2] is None or entry[2] > now
+
+
+def _getPath(obj, key_ref=None):
+    """return the key references of obj and its ancestors, root first.
+
+    The ancestors are found by following `__parent__`, up to the first one
+    that has no key reference.
+    """
+    if key_ref is None:
+        key_ref = IKeyReference(obj)
+    path = [key_ref]
+    parent = getattr(obj, '__parent__', None)
+    while parent is not None:
+        parent_ref = IKeyReference(parent, None)
+        if parent_ref is None:
+            break
+        path.append(parent_ref)
+        parent = getattr(parent, '__parent__', None)
+    path.reverse()
+    return tuple(path)
+
+
+def _getMovedPaths(obj, old_parent):
+    """return the old and the new path of a moved object, or None if it has
+    no key reference."""
+    key_ref = IKeyReference(obj, None)
+    if key_ref is None:
+        return None
+    old_path = (key_ref,)
+    if old_parent is not None:
+        parent_ref = IKeyReference(old_parent, None)
+        if parent_ref is not None:
+            old_path = _getPath(old_parent, parent_ref) + old_path
+    return old_path, _getPath(obj, key_ref)
+
+
+@component.adapter(interface.Interface, IObjectMovedEvent)
+def objectMoved(obj, event):
+    """reindex the locations of the tokens at and below a moved object.
+
+    Added objects have nothing indexed below them, and the event sent again
+    for each sublocation of the moved object is left alone: the object
+    itself reindexes everything below it.  Token utilities that do not
+    index locations have no `reindexMoved` method.
+    """
+    if event.object is not obj or event.oldParent is None:
+        return
+    util = component.queryUtility(
+        interfaces.ITokenUtility, context=event.oldParent)
+    reindexMoved = getattr(util, 'reindexMoved', None)
+    if reindexMoved is not None:
+        reindexMoved(obj, event.oldParent)
+
+
+def _getTokenPath(token, key_ref):
+    path = getattr(token, '_path', None)
+    if path is None:
+        path = _getPath(token.context, key_ref)
+    return path
+
+
+def _checkOnce(seen, key, token):
+    """check that a batch locks the object of `key` only once.
+
+    `seen` maps the keys checked so far to their tokens.
+    """
+    other = seen.get(key)
+    if other is token:
+        raise ValueError('token is given more than once', token)
+    if other is not None:
+        raise ValueError('object is given more than once', token)
+    seen[key] = token
+
+
+def _checkBatch(checked):
+    """check that no deep token of a batch covers another token of it.
+
+    `checked` is a list of (token, key reference, current entry, path)
+    tuples, one for each token of the batch.
+    """
+    paths = sorted((path, i) for i, (token, key_ref, current, path)
+                   in enumerate(checked))
+    for pos, (path, i) in enumerate(paths):
+        if getattr(checked[i][0], 'deep', False) and pos + 1 < len(paths):
+            other_path = paths[pos + 1][0]
+            if other_path[:len(path)] == path:
+                raise interfaces.RegistrationError(checked[i][0])
+
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_ONE_SECOND = datetime.timedelta(seconds=1)
+_ONE_HOUR = datetime.timedelta(hours=1)
+
+
+class _IndexChanges:
+    """changes to the token sets of the `_expirations` and `_principal_ids`
+    indexes, collected so that each set is written once.
+
+    A token that is added and then removed again (or the reverse) is left
+    alone.
+    """
+
+    def __init__(self):
+        self._changes = {}
+
+    def _record(self, name, value, token, added):
+        changes = self._changes.setdefault((name, value), {})
+        first = changes.get(id(token), (token, added))[1]
+        changes[id(token)] = (token, first, added)
+
+    def add(self, name, value, token):
+        self._record(name, value, token, True)
+
+    def remove(self, name, value, token):
+        self._record(name, value, token, False)
+
+    def __iter__(self):
+        """iterate over (index name, value, removed tokens, added tokens)"""
+        for (name, value), changes in self._changes.items():
+            removed = [token for token, first, last in changes.values()
+                       if not first and not last]
+            added = [token for token, first, last in changes.values()
+                     if first and last]
+            yield name, value, removed, added
+
+
+class _LookupCache:
+    """key references and `_locks` entries looked up in a transaction.
+
+    A page can ask about the same objects many times.  The cache is
+    registered as a synchronizer with the transaction manager of the
+    utility's connection, so that it is emptied when a transaction ends or
+    begins; the utility empties the entries whenever it changes `_locks`.
+    Once it holds entries, it also joins the transaction as a data manager,
+    so that rolling back a savepoint empties them.  Both are keyed by the
+    id of the object, which the key references keep alive.
+    """
+
+    def __init__(self, transaction_manager):
+        self.transaction_manager = transaction_manager
+        self.key_refs = {}
+        self.entries = {}
+        self.joined = False
+        transaction_manager.registerSynch(self)
+
+    def clear(self):
+        self.key_refs.clear()
+        self.entries.clear()
+        self.joined = False
+
+    def join(self):
+        self.transaction_manager.get().join(self)
+        self.joined = True
+
+    # ISynchronizer
+
+    def beforeCompletion(self, transaction):
+        pass
+
+    def afterCompletion(self, transaction):
+        self.clear()
+
+    def newTransaction(self, transaction):
+        self.clear()
+
+    # IDataManager, with nothing to commit.  `abort` is also called to roll
+    # back a savepoint taken before the cache joined.
+
+    def abort(self, transaction):
+        self.entries.clear()
+        self.joined = False
+
+    def tpc_begin(self, transaction):
+        pass
+
+    def commit(self, transaction):
+        pass
+
+    def tpc_vote(self, transaction):
+        pass
+
+    def tpc_finish(self, transaction):
+        pass
+
+    def tpc_abort(self, transaction):
+        pass
+
+    def sortKey(self):
+        return 'zope.locking.utility._LookupCache:%d' % (id(self),)
+
+    # ISavepointDataManager
+
+    def savepoint(self):
+        return _LookupCacheSavepoint(self)
+
+
+class _LookupCacheSavepoint:
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def rollback(self):
+        self.cache.entries.clear()
+
+
+TokenInfo = collections.namedtuple(
+    'TokenInfo', ('token', 'principal_ids', 'expiration', 'kind'))
+
+TokenStats = collections.namedtuple(
+    'TokenStats', ('tokens', 'kinds', 'pending', 'expiring', 'principals'))
+
+
 @interface.implementer(interfaces.ITokenUtility)
 class TokenUtility(persistent.Persistent, Location):
 
+    # the most expired tokens that `register` will clean out as a side effect.
+    # Anything beyond that is left for the next registration, or for a
+    # separate process calling `reap`.  None means no limit.
+    cleanup_limit = 10
+
+    # the length, in seconds, of the time slices that group tokens in the
+    # `_expirations` index.  Changing it for a utility that already has tokens
+    # requires reindexing them.
+    expiration_resolution = 60
+
+    # counters of the tokens in `_locks`, of those tokens by kind, and of the
+    # tokens of each principal in `_principal_ids`.  Utilities from before
+    # generation 6 of the package's schema have none, and count their tokens
+    # by iterating.
+    _length = _kind_counts = _principal_counts = None
+
+    # the tokens by the path of their context, root first.  Utilities from
+    # before generation 4 have none until they are evolved to it, which has
+    # to load every locked object: they find the tokens below a new deep
+    # token by going through `_locks`.
+    _paths = None
+
     def __init__(self):
         self._locks = OOBTree()
         self._expirations = OOBTree()
         self._principal_ids = OOBTree()
+        self._paths = OOBTree()
+        self._length = Length()
+        self._kind_counts = _newKindCounts()
+        self._principal_counts = OOBTree()
+
+    def _countEntry(self, entry, delta):
+        """count a `_locks` entry in (delta 1) or out of (delta -1) the
+        counters"""
+        if self._length is not None:
+            self._length.change(delta)
+        if self._kind_counts is not None:
+            self._kind_counts[_getEntryKind(entry)].change(delta)
+
+    def _changePrincipalCount(self, principal_id, delta):
+        counts = self._principal_counts
+        if counts is None or not delta:
+            return
+        count = counts.get(principal_id)
+        if count is None:
+            count = counts[principal_id] = Length()
+        count.change(delta)
+        if not count():
+            del counts[principal_id]
 
     def _del(self, tree, token, value):
         """remove a token for a value within either of the two index trees"""
+        self._delMany(tree, (token,), value)
+
+    def _add(self, tree, token, value):
+        """add a token for a value within either of the two index trees"""
+        self._addMany(tree, (token,), value)
+
+    def _delMany(self, tree, tokens, value):
+        """remove tokens for a value within either of the two index trees"""
         reg = tree[value]
-        reg.remove(token)
+        for token in tokens:
+            reg.remove(token)
         if not reg:
             del tree[value]
 
-    def _add(self, tree, token, value):
-        """add a token for a value within either of the two index trees"""
+    def _addMany(self, tree, tokens, value):
+        """add tokens for a value within either of the two index trees"""
         reg = tree.get(value)
         if reg is None:
-            reg = tree[value] = OOTreeSet()
-        reg.insert(token)
-
-    def _cleanup(self):
-        "clean out expired keys"
-        expiredkeys = []
-        for k in self._expirations.keys(max=utils.now()):
-            for token in self._expirations[k]:
+            reg = tree[value] = trees.TokenTreeSet()
+        reg.update(tokens)
+
+    def _expirationKey(self, expiration):
+        """return the `_expirations` key for an expiration datetime.
+
+        This is the end of the time slice the expiration falls in, in seconds
+        since the epoch, so every token in the slice has expired once the key
+        has passed.
+        """
+        if expiration is None:
+            return None
+        resolution = self.expiration_resolution
+        return -((_EPOCH - expiration) // (_ONE_SECOND * resolution)) * (
+            resolution)
+
+    @instrumentation.timed('cleanup', result='cleanup.reaped')
+    def _cleanup(self, max_tokens=None, deadline=None):
+        """clean out expired keys.
+
+        Stops after `max_tokens` tokens have been removed, or once
+        `time.monotonic()` passes `deadline`; either may be None for no limit.
+        Returns the number of tokens removed.
+        """
+        count = 0
+        now = (utils.now() - _EPOCH) // _ONE_SECOND
+        while self._expirations:
+            k = self._expirations.minKey()
+            if k > now or max_tokens is not None and count >= max_tokens:
+                break
+            # copy out only the tokens that may be removed, as removing them
+            # changes the set
+            for token in list(itertools.islice(
+                    self._iterExpiring(k),
+                    None if max_tokens is None else max_tokens - count)):
+                if deadline is not None and time.monotonic() > deadline:
+                    return count
                 assert token.ended
                 for p in token.principal_ids:
                     self._del(self._principal_ids, token, p)
-                key_ref = IKeyReference(token.context)
-                del self._locks[key_ref]
-            expiredkeys.append(k)
-        for k in expiredkeys:
-            del self._expirations[k]
+                    self._changePrincipalCount(p, -1)
+                key_ref = _getKeyReference(token)
+                current = self._locks.get(key_ref)
+                if current is not None and current[0] is token:
+                    self._invalidateLookups()
+                    del self._locks[key_ref]
+                    self._countEntry(current, -1)
+                self._unindexPath(token)
+                self._del(self._expirations, token, k)
+                count += 1
+        return count
 
-    def register(self, token):
+    def _iterExpiring(self, key):
+        """iterate over the tokens of a slice of `_expirations`"""
+        return iter(self._expirations[key])
+
+    def reap(self, max_tokens=None, max_seconds=None):
+        deadline = None
+        if max_seconds is not None:
+            deadline = time.monotonic() + max_seconds
+        return self._cleanup(max_tokens, deadline)
+
+    @instrumentation.timed('register.check')
+    def _check(self, token):
+        """check that token may be registered, without changing anything.
+
+        Returns the key reference of the token's context, its current
+        `_locks` entry or None, and the path of the context.
+        """
         assert interfaces.IToken.providedBy(token)
+        if token.utility is not None and token.utility is not self:
+            raise ValueError('Lock is already registered with another utility')
+        key_ref = _getKeyReference(token)
+        current = self._locks.get(key_ref)
+        path = _getTokenPath(token, key_ref)
+        if current is None or current[0] is not token:
+            now = utils.now()
+            if current is not None and _getEntryKind(current).isOrExtends(
+                    interfaces.IEndable) and _isEntryActive(current, now):
+                raise interfaces.RegistrationError(token)
+            # ancestors
+            for ancestor in path[:-1]:
+                entry = self._locks.get(ancestor)
+                if (entry is not None and _isEntryDeep(entry) and
+                        _isEntryActive(entry, now)):
+                    raise interfaces.RegistrationError(token)
+            # descendants, whose paths sort right after the path
+            if getattr(token, 'deep', False):
+                for other_path, other in self._iterBelow(path):
+                    if other_path == path:
+                        continue
+                    entry = self._locks.get(other_path[-1])
+                    if (entry is not None and entry[0] is other and
+                            _isEntryActive(entry, now)):
+                        raise interfaces.RegistrationError(token)
+        return key_ref, current, path
+
+    def _iterBelow(self, path):
+        """iterate over the (path, token) pairs at and below path"""
+        if self._paths is None:
+            for key_ref, entry in self._locks.items():
+                other_path = _getTokenPath(entry[0], key_ref)
+                if other_path[:len(path)] == path:
+                    yield other_path, entry[0]
+            return
+        for other_path, other in self._paths.items(path):
+            if other_path[:len(path)] != path:
+                break
+            yield other_path, other
+
+    def reindexMoved(self, obj, old_parent):
+        if self._paths is None:
+            # nothing is indexed, and no path is kept on the tokens
+            return
+        paths = _getMovedPaths(obj, old_parent)
+        if paths is None or paths[0] == paths[1]:
+            return
+        old_path, new_path = paths
+        moved = []
+        for path, token in self._paths.items(old_path):
+            if path[:len(old_path)] != old_path:
+                break
+            moved.append((path, token))
+        for path, token in moved:
+            del self._paths[path]
+        for path, token in moved:
+            path = new_path + path[len(old_path):]
+            self._paths[path] = token
+            if isinstance(token, tokens.Token):
+                token._path = path
+
+    def _unindexPath(self, token):
+        path = getattr(token, '_path', None)
+        if (path is not None and self._paths is not None and
+                self._paths.get(path) is token):
+            del self._paths[path]
+
+    @instrumentation.timed('register.index')
+    def _index(self, token, key_ref, current, path, changes):
+        """index a token that has passed `_check`.
+
+        The `_locks` index is changed at once; changes to the sets of the
+        other two indexes are collected in `changes`, an `_IndexChanges`, for
+        `_applyChanges`.  Returns True if the token is new to the utility.
+        A token whose entry would not change is left alone, so that
+        registering it again writes nothing.
+        """
         if token.utility is None:
             token.utility = self
-        elif token.utility is not self:
-            raise ValueError('Lock is already registered with another utility')
         if persistent.interfaces.IPersistent.providedBy(token):
             self._p_jar.add(token)
-        key_ref = IKeyReference(token.context)
-        current = self._locks.get(key_ref)
-        if current is not None:
-            current, principal_ids, expiration = current
-            current_endable = interfaces.IEndable.providedBy(current)
-            if current is not token:
-                if current_endable and not current.ended:
-                    raise interfaces.RegistrationError(token)
-                # expired token: clean up indexes and fall through
-                if current_endable and expiration is not None:
-                    self._del(self._expirations, current, expiration)
-                for p in principal_ids:
-                    self._del(self._principal_ids, current, p)
+        if isinstance(token, tokens.Token):
+            if token._key_ref is None:
+                token._key_ref = key_ref
+            if token._path is None and self._paths is not None:
+                token._path = path
+        reindex = current is not None and current[0] is token
+        if reindex:
+            ended = _getEntryKind(current).isOrExtends(
+                interfaces.IEndable) and token.ended
+            if not ended:
+                entry = _makeEntry(token)
+                if entry[1:] == current[1:]:
+                    # same principals and expiration: leave the buckets alone
+                    if instrumentation.sink is not None:
+                        instrumentation.sink.incr('register.unchanged')
+                    return False
+        self._invalidateLookups()
+        if reindex:
+            if ended:
+                del self._locks[key_ref]
+                self._countEntry(current, -1)
+                self._unindexPath(token)
+                entry = (token, (), None)
             else:
-                # current is token; reindex and return
-                if current_endable and token.ended:
-                    if expiration is not None:
-                        self._del(self._expirations, token, expiration)
-                    for p in principal_ids:
-                        self._del(self._principal_ids, token, p)
-                    del self._locks[key_ref]
-                else:
-                    if current_endable and token.expiration != expiration:
-                        # reindex timeout
-                        if expiration is not None:
-                            self._del(self._expirations, token, expiration)
-                        if token.expiration is not None:
-                            self._add(
-                                self._expirations, token, token.expiration)
-                    orig = frozenset(principal_ids)
-                    new = frozenset(token.principal_ids)
-                    removed = orig.difference(new)
-                    added = new.difference(orig)
-                    for p in removed:
-                        self._del(self._principal_ids, token, p)
-                    for p in added:
-                        self._add(self._principal_ids, token, p)
-                    self._locks[key_ref] = (
-                        token,
-                        frozenset(token.principal_ids),
-                        current_endable and token.expiration or None)
-                self._cleanup()
-                return token
-        # expired current token or no current token; this is new
-        endable = interfaces.IEndable.providedBy(token)
-        self._locks[key_ref] = (
-            token,
-            frozenset(token.principal_ids),
-            endable and token.expiration or None)
-        if (endable and
-                token.expiration is not None):
-            self._add(self._expirations, token, token.expiration)
-        for p in token.principal_ids:
-            self._add(self._principal_ids, token, p)
-        self._cleanup()
-        event.notify(interfaces.TokenStartedEvent(token))
+                self._locks[key_ref] = entry
+            is_new = False
+        else:
+            if current is not None:
+                self._unindexPath(current[0])
+                self._countEntry(current, -1)
+            entry = self._locks[key_ref] = _makeEntry(token)
+            self._countEntry(entry, 1)
+            if self._paths is not None:
+                self._paths[path] = token
+            is_new = True
+        if current is not None:
+            # reindex, or clean up after the expired token we replace
+            old_token, old_principal_ids, old_expiration = current[:3]
+        else:
+            old_token, old_principal_ids, old_expiration = token, (), None
+        old_key = self._expirationKey(old_expiration)
+        new_key = self._expirationKey(entry[2])
+        if old_token is not token or old_key != new_key:
+            if old_key is not None:
+                changes.remove('_expirations', old_key, old_token)
+            if new_key is not None:
+                changes.add('_expirations', new_key, token)
+        old_principal_ids = utils.unpackPrincipalIds(old_principal_ids)
+        new_principal_ids = utils.unpackPrincipalIds(entry[1])
+        if old_token is not token:
+            removed, added = old_principal_ids, new_principal_ids
+        else:
+            removed = old_principal_ids.difference(new_principal_ids)
+            added = new_principal_ids.difference(old_principal_ids)
+        for p in removed:
+            changes.remove('_principal_ids', p, old_token)
+        for p in added:
+            changes.add('_principal_ids', p, token)
+        return is_new
+
+    @instrumentation.timed('register.write')
+    def _applyChanges(self, changes):
+        """write changes collected by `_index`, one set at a time"""
+        for name, value, removed, added in changes:
+            tree = getattr(self, name)
+            if removed:
+                self._delMany(tree, removed, value)
+            if added:
+                self._addMany(tree, added, value)
+            if name == '_principal_ids':
+                self._changePrincipalCount(value, len(added) - len(removed))
+
+    @instrumentation.timed('register')
+    def register(self, token):
+        key_ref, current, path = self._check(token)
+        changes = getattr(self, '_v_changes', None)
+        if changes is None:
+            changes = _IndexChanges()
+            is_new = self._index(token, key_ref, current, path, changes)
+            self._applyChanges(changes)
+            self._cleanup(self.cleanup_limit)
+        else:
+            # `endMany` or `refreshMany` will write the changes
+            is_new = self._index(token, key_ref, current, path, changes)
+        if is_new:
+            events.notify(interfaces.TokenStartedEvent(token))
         return token
 
+    @instrumentation.timed('registerMany')
+    def registerMany(self, tokens):
+        tokens = list(tokens)
+        checked = []
+        seen = {}
+        for token in tokens:
+            key_ref, current, path = self._check(token)
+            _checkOnce(seen, key_ref, token)
+            checked.append((token, key_ref, current, path))
+        _checkBatch(checked)
+        changes = _IndexChanges()
+        started = [token for token, key_ref, current, path in checked
+                   if self._index(token, key_ref, current, path, changes)]
+        self._applyChanges(changes)
+        self._cleanup(self.cleanup_limit)
+        for token in started:
+            events.notify(interfaces.TokenStartedEvent(token))
+        return tokens
+
+    def _checkRegistered(self, tokens):
+        tokens = list(tokens)
+        seen = set()
+        for token in tokens:
+            if not interfaces.IEndable.providedBy(token):
+                raise TypeError('token is not endable', token)
+            if token.utility is not self:
+                raise ValueError('token is not registered with this utility')
+            if token.ended:
+                raise interfaces.EndedError(token)
+            if id(token) in seen:
+                raise ValueError('token is given more than once', token)
+            seen.add(id(token))
+        return tokens
+
+    def _registerChanged(self, tokens, change):
+        """call `change` for each token, writing the index sets once.
+
+        Tokens call `register` themselves when they change; while this runs,
+        `register` updates the `_locks` index and leaves the changes to the
+        sets of the other indexes to be written at the end.
+        """
+        self._v_changes = changes = _IndexChanges()
+        try:
+            for token in tokens:
+                change(token)
+        finally:
+            # `_locks` already has the changes made before any error
+            del self._v_changes
+            self._applyChanges(changes)
+        self._cleanup(self.cleanup_limit)
+
+    @instrumentation.timed('endMany')
+    def endMany(self, tokens):
+        tokens = self._checkRegistered(tokens)
+        self._registerChanged(tokens, lambda token: token.end())
+        return tokens
+
+    @instrumentation.timed('refreshMany')
+    def refreshMany(self, tokens, duration):
+        tokens = self._checkRegistered(tokens)
+        if duration is not None:
+            if not isinstance(duration, datetime.timedelta):
+                raise ValueError('duration must be datetime.timedelta')
+            if duration < datetime.timedelta():
+                raise ValueError('duration may not be negative')
+
+        def refresh(token):
+            token.remaining_duration = duration
+
+        self._registerChanged(tokens, refresh)
+        return tokens
+
+    def _getLookupCache(self):
+        jar = self._p_jar
+        if jar is None:
+            return None
+        cache = getattr(self, '_v_lookups', None)
+        # the connection may have been reopened with another manager
+        if cache is None or (
+                cache.transaction_manager is not jar.transaction_manager):
+            cache = self._v_lookups = _LookupCache(jar.transaction_manager)
+        return cache
+
+    def _invalidateLookups(self):
+        cache = getattr(self, '_v_lookups', None)
+        if cache is not None:
+            cache.entries.clear()
+
+    def _lookup(self, obj):
+        """return the `_locks` entry for obj, or None, through the lookup
+        cache"""
+        cache = self._getLookupCache()
+        if cache is None:
+            return self._locks.get(_adaptKeyReference(obj))
+        key = id(obj)
+        try:
+            return cache.entries[key]
+        except KeyError:
+            pass
+        found = cache.key_refs.get(key)
+        if found is None:
+            key_ref = _adaptKeyReference(obj)
+            cache.key_refs[key] = (obj, key_ref)
+        else:
+            key_ref = found[1]
+        if not cache.joined:
+            cache.join()
+        entry = cache.entries[key] = self._locks.get(key_ref)
+        return entry
+
+    def _query(self, obj):
+        """return the index entry for obj if its token is active, or None.
+
+        This only uses the information in the index, so it does not load
+        the token.
+        """
+        res = self._lookup(obj)
+        if res is not None and res[2] is not None and res[2] <= utils.now():
+            res = None
+        if instrumentation.sink is not None:
+            instrumentation.sink.incr('get.miss' if res is None else 'get.hit')
+        return res
+
     def get(self, obj, default=None):
-        res = self._locks.get(IKeyReference(obj))
-        if res is not None and (
-                not interfaces.IEndable.providedBy(res[0])
-                or not res[0].ended):
+        res = self._query(obj)
+        if res is not None:
             return res[0]
         return default
 
-    def iterForPrincipalId(self, principal_id):
-        locks = self._principal_ids.get(principal_id, ())
-        for lock in locks:
-            assert principal_id in frozenset(lock.principal_ids)
-            if not lock.ended:
-                yield lock
+    def query(self, obj, default=None):
+        res = self._query(obj)
+        if res is not None:
+            return TokenInfo(res[0], utils.unpackPrincipalIds(res[1]),
+                             res[2], _getEntryKind(res))
+        return default
+
+    def isLocked(self, obj):
+        return self._query(obj) is not None
 
-    def __iter__(self):
-        for lock in self._locks.values():
-            if (not interfaces.IEndable.providedBy(lock[0])
-                    or not lock[0].ended):
-                yield lock[0]
+    @instrumentation.timed('getMany')
+    def getMany(self, objects):
+        objects = list(objects)
+        cache = self._getLookupCache()
+        entries = {}
+        missing = {}  # key reference: ids of the objects
+        for obj in objects:
+            key = id(obj)
+            if key in entries:
+                continue
+            if cache is not None and key in cache.entries:
+                entries[key] = cache.entries[key]
+                continue
+            cached = None if cache is None else cache.key_refs.get(key)
+            if cached is None:
+                key_ref = _adaptKeyReference(obj)
+                if cache is not None:
+                    cache.key_refs[key] = (obj, key_ref)
+            else:
+                key_ref = cached[1]
+            entries[key] = None
+            missing.setdefault(key_ref, []).append(key)
+        found = trees.getSorted(self._locks, sorted(missing))
+        if missing and cache is not None and not cache.joined:
+            cache.join()
+        for key_ref, keys in missing.items():
+            entry = found.get(key_ref)
+            for key in keys:
+                entries[key] = entry
+                if cache is not None:
+                    cache.entries[key] = entry
+        now = utils.now()
+        result = {}
+        for obj in objects:
+            entry = entries[id(obj)]
+            if entry is not None and _isEntryActive(entry, now):
+                result[obj] = entry[0]
+            else:
+                result[obj] = None
+        sink = instrumentation.sink
+        if sink is not None:
+            hits = sum(token is not None for token in result.values())
+            sink.incr('get.hit', hits)
+            sink.incr('get.miss', len(result) - hits)
+        return result
+
+    def getEffective(self, obj, default=None):
+        path = _getPath(obj)
+        now = utils.now()
+        entry = self._locks.get(path[-1])
+        if entry is not None and _isEntryActive(entry, now):
+            return entry[0]
+        for ancestor in reversed(path[:-1]):
+            entry = self._locks.get(ancestor)
+            if (entry is not None and _isEntryDeep(entry) and
+                    _isEntryActive(entry, now)):
+                return entry[0]
+        return default
+
+    def iterForPrincipalId(self, principal_id, start=None, limit=None):
+        locks = self._principal_ids.get(principal_id)
+        if locks is None:
+            return
+        if start is not None:
+            # the sets are ordered by token
+            locks = locks.keys(start, excludemin=True)
+        yield from itertools.islice(
+            (lock for lock in locks if not lock.ended), limit)
+
+    def countForPrincipalId(self, principal_id):
+        if self._principal_counts is None:
+            return len(self._principal_ids.get(principal_id, ()))
+        count = self._principal_counts.get(principal_id)
+        return count() if count is not None else 0
+
+    def __iter__(self, start=None, limit=None):
+        now = utils.now()
+        if start is None:
+            entries = self._locks.values()
+        else:
+            # the index is ordered by key reference
+            entries = self._locks.values(
+                _getKeyReference(start), excludemin=True)
+        yield from itertools.islice(
+            (entry[0] for entry in entries if _isEntryActive(entry, now)),
+            limit)
+
+    def __len__(self):
+        if self._length is None:
+            return len(self._locks)
+        return self._length()
+
+    def __bool__(self):
+        # the utility is there even when it has no tokens
+        return True
+
+    def stats(self, principal_ids=(), expiring_within=_ONE_HOUR):
+        if self._kind_counts is None:
+            kinds = dict.fromkeys(_KINDS, 0)
+            for entry in self._locks.values():
+                kinds[_getEntryKind(entry)] += 1
+        else:
+            kinds = {kind: count()
+                     for kind, count in self._kind_counts.items()}
+        # the expirations are counted by time slice, from the sizes of the
+        # sets, so no token is loaded
+        now = utils.now()
+        now_key = (now - _EPOCH) // _ONE_SECOND
+        pending = sum(len(members) for key, members in
+                      self._expirations.items(None, now_key))
+        expiring = sum(len(members) for key, members in
+                       self._expirations.items(
+                           now_key, self._expirationKey(now + expiring_within),
+                           excludemin=True))
+        if principal_ids is None:
+            principal_ids = self._principal_ids.keys()
+        principals = {principal_id: self.countForPrincipalId(principal_id)
+                      for principal_id in principal_ids}
+        return TokenStats(
+            len(self), kinds, pending, expiring, principals)
+
+    def iterExpiringBetween(self, start=None, end=None):
+        first = self._expirationKey(start)
+        last = self._expirationKey(end)
+        for key, expiring in self._expirations.items(first, last):
+            if key != first and key != last:
+                # the whole time slice is in the range
+                yield from expiring
+                continue
+            for token in expiring:
+                expiration = token.expiration
+                if ((start is None or expiration >= start) and
+                        (end is None or expiration < end)):
+                    yield token
+
+
+class ShardedTokenUtility(TokenUtility):
+    """A token utility for many concurrent writers.
+
+    Each of the indexes is spread over `shards` independently persisted
+    BTrees, by key reference, principal id, location or token, so that
+    transactions locking different objects rarely write the same BTree.
+    """
+
+    def __init__(self, shards=16):
+        self._locks = trees.ShardedTree(shards)
+        # tokens registered together expire in the same time slice, so the
+        # sets of the slices are sharded by token rather than by key
+        self._expirations = trees.ShardedSets(shards)
+        self._principal_ids = trees.ShardedTree(shards)
+        self._paths = trees.ShardedTree(shards)
+        self._length = Length()
+        self._kind_counts = _newKindCounts()
+        self._principal_counts = trees.ShardedTree(shards)
+
+    def _iterExpiring(self, key):
+        return self._expirations.iterTokens(key)
+
+    def _addMany(self, tree, tokens, value):
+        if isinstance(tree, trees.ShardedSets):
+            for shard, group in tree.byShard(tokens):
+                super()._addMany(shard, group, value)
+        else:
+            super()._addMany(tree, tokens, value)
+
+    def _delMany(self, tree, tokens, value):
+        if isinstance(tree, trees.ShardedSets):
+            for shard, group in tree.byShard(tokens):
+                super()._delMany(shard, group, value)
+        else:
+            super()._delMany(tree, tokens, value)
@@ -13,11 +13,115 @@
 ##############################################################################
 
 import datetime
+import threading
 
-import pytz
+
+def systemClock():
+    """Return the current time, in UTC."""
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+_clock = systemClock
 
 
-# this is a small convenience, but is more important as a convenient monkey-
-# patch opportunity for the package's README.txt doctest.
 def now():
-    return datetime.datetime.now(pytz.utc)
+    """Return the current time, in UTC, from the installed clock.
+
+    Everything in the package asks this function for the time, so that
+    `setClock` changes it everywhere.
+    """
+    return _clock()
+
+
+def getClock():
+    """Return the installed clock."""
+    return _clock
+
+
+def setClock(clock):
+    """Install clock for `now` to use.
+
+    A clock is a callable returning a timezone-aware datetime.  None
+    installs `systemClock` again.
+    """
+    global _clock
+    _clock = systemClock if clock is None else clock
+
+
+class FakeClock:
+    """A clock that only moves when it is told to, for tests and benchmarks.
+
+    It can be installed with `setClock`, or used as a context manager that
+    installs it and puts the previous clock back.
+    """
+
+    def __init__(self, now=None):
+        self.now = systemClock() if now is None else now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, delta=None, **kwargs):
+        """move the clock forward by a timedelta, or by timedelta arguments
+        """
+        self.now += delta if delta is not None else datetime.timedelta(
+            **kwargs)
+
+    def __enter__(self):
+        self._previous = getClock()
+        setClock(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        setClock(self._previous)
+
+
+class TransactionClock(threading.local):
+    """A clock that is read once per transaction.
+
+    Every token started, ended or checked in a transaction gets the same
+    time, and the underlying clock is read only once.  The clock registers
+    itself as a synchronizer with the transaction manager, in each thread
+    that uses it, and forgets the time when a transaction begins or ends.
+    """
+
+    def __init__(self, transaction_manager, clock=systemClock):
+        self.transaction_manager = transaction_manager
+        self.clock = clock
+        self.now = None
+        transaction_manager.registerSynch(self)
+
+    def __call__(self):
+        now = self.now
+        if now is None:
+            now = self.now = self.clock()
+        return now
+
+    # ISynchronizer
+
+    def beforeCompletion(self, transaction):
+        pass
+
+    def afterCompletion(self, transaction):
+        self.now = None
+
+    def newTransaction(self, transaction):
+        self.now = None
+
+
+# Principal ids are stored in token pickles and in the `_locks` index.  Most
+# tokens are exclusive locks with a single principal, which is stored as is;
+# other sets are stored as sorted tuples, which pickle smaller than frozensets.
+
+def packPrincipalIds(principal_ids):
+    if len(principal_ids) == 1:
+        for principal_id in principal_ids:
+            if isinstance(principal_id, str):
+                return principal_id
+    return tuple(sorted(principal_ids))
+
+
+def unpackPrincipalIds(packed):
+    if isinstance(packed, str):
+        return frozenset((packed,))
+    return frozenset(packed)